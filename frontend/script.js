@@ -16,6 +16,7 @@ document.addEventListener('alpine:init', () => {
         backendStatus: 0,
         backendMessage: '',
         requestInProgress: false,
+        progressMessage: '',
         wishHistoryURL: '',
 
         uidData: {},
@@ -184,6 +185,7 @@ document.addEventListener('alpine:init', () => {
             // reset message and status, show loading animation
             this.backendStatus = 0;
             this.backendMessage = '';
+            this.progressMessage = '';
             this.requestInProgress = true;
 
             fetch('/update-wish-history', {
@@ -201,19 +203,58 @@ document.addEventListener('alpine:init', () => {
                         });
                     });
                 });
-            }, (error) => {
-                this.backendStatus = 400;
-                this.backendMessage = 'Connection failed! Try restarting Wishing Well.';
-                throw error;
             }).then((json) => {
-                this.backendStatus = json.status;
-                this.backendMessage = json.data?.message || 'An unknown error has occurred.';
-                this.loadData();
-            }).finally(() => {
-                this.requestInProgress = false;
+                // the update is running in the background now
+                if (json.status == 202) {
+                    this.followUpdate(json.data.job);
+                    return;
+                }
+
+                this.finishUpdate(json.status, json.data?.message);
+            }, (error) => {
+                this.finishUpdate(400, 'Connection failed! Try restarting Wishing Well.', false);
+            });
+        },
+
+        // follow the progress of a background update via server-sent events
+        followUpdate(job) {
+            const events = new EventSource(`/update-wish-history/${job}`);
+            events.addEventListener('progress', (event) => {
+                this.progressMessage = this.formatProgress(JSON.parse(event.data));
+            });
+            events.addEventListener('done', (event) => {
+                events.close();
+                const result = JSON.parse(event.data);
+                this.finishUpdate(result.status, result.message);
+            });
+            events.addEventListener('error', () => {
+                events.close();
+                this.finishUpdate(400, 'Connection failed! Try restarting Wishing Well.', false);
             });
         },
 
+        formatProgress(progress) {
+            const lines = [];
+            for (const [ bannerType, banner ] of Object.entries(progress.banners)) {
+                const name = this.bannerTypes[bannerType] ?? bannerType;
+                lines.push(`${name}: ${banner.wishes} ${banner.wishes == 1 ? 'wish' : 'wishes'} from ${banner.pages} ${banner.pages == 1 ? 'page' : 'pages'}${banner.done ? ', done' : ''}`);
+            }
+            if (progress.averageLatency != null) {
+                lines.push(`${progress.requests} requests, ${Math.round(progress.averageLatency * 1000)} ms on average`);
+            }
+
+            return lines.join('\n');
+        },
+
+        finishUpdate(status, message, reload = true) {
+            this.backendStatus = status;
+            this.backendMessage = message || 'An unknown error has occurred.';
+            this.requestInProgress = false;
+            if (reload) {
+                this.loadData();
+            }
+        },
+
         // page and filter the wish history for display
         pageWishHistory() {
             // first, turn our filters into lists
@@ -0,0 +1,111 @@
+# measure the overhead of a single small database call: opening a new
+# connection for every call, like the database used to, against the
+# long-lived connections Database keeps now. then measure how long reads
+# take while a bulk insert is running, with the default rollback journal
+# and with the write-ahead log and tuned pragmas Database uses now
+#
+#   python tools/benchmark_database.py --calls 2000
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+from threading import Thread
+from time import monotonic
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from wishing_well.database import Database  # noqa: E402
+from wishing_well.enums import ItemType  # noqa: E402
+
+
+def per_call_connection(database_path, uid, banner_type):
+    connection = sqlite3.connect(database_path, detect_types=sqlite3.PARSE_DECLTYPES)
+    cursor = connection.cursor()
+    cursor.execute('SELECT MAX(id) FROM wish_history WHERE uid = ? AND banner_type = ?', (uid, banner_type)).fetchone()
+    cursor.close()
+    connection.close()
+
+
+def measure(calls, function, *args):
+    start = monotonic()
+    for _ in range(calls):
+        function(*args)
+    return (monotonic() - start) / calls
+
+
+def create_database():
+    data_path = tempfile.mkdtemp(prefix='wishing-well-benchmark-')
+    os.environ['XDG_DATA_HOME'] = data_path
+    os.environ['APPDATA'] = data_path
+    return Database()
+
+
+def create_wishes(count, first_id=1000000000):
+    return [ {
+        'id': first_id + i,
+        'uid': 700000000,
+        'banner_type': 301,
+        'type': ItemType.CHARACTER,
+        'rarity': 3,
+        'time': '2022-01-01 00:00:00',
+        'name': 'Wish'
+    } for i in range(count) ]
+
+
+# read latencies while another thread stores batches of wishes, one transaction each
+def measure_concurrent_reads(database, batches, batch_size):
+    def insert():
+        for batch in range(batches):
+            database.store_wish_history(create_wishes(batch_size, 2000000000 + batch * batch_size))
+
+    latencies = []
+    writer = Thread(target=insert)
+    writer.start()
+    while writer.is_alive():
+        start = monotonic()
+        database.get_latest_wish_id(700000000, 301)
+        latencies.append(monotonic() - start)
+    writer.join()
+
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], latencies[-1], len(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the per-call overhead of database reads and writes, and reads during writes.')
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--wishes', type=int, default=5000)
+    parser.add_argument('--batches', type=int, default=200, help='batches stored during the concurrent read benchmark')
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+
+    database = create_database()
+    database.store_wish_history(create_wishes(args.wishes))
+
+    results = [
+        ( 'read, connection per call', measure(args.calls, per_call_connection, database._database_path, 700000000, 301) ),
+        ( 'read, pooled connection', measure(args.calls, database.get_latest_wish_id, 700000000, 301) ),
+        ( 'write, writer connection', measure(args.calls, database.store_meta, 'benchmark', 1) )
+    ]
+
+    for name, duration in results:
+        print(f'{name:>26}: {duration * 1000000:8.1f}µs per call')
+    database.close()
+
+    print()
+    print(f'{"storage":>26}  {"median":>8} {"p99":>8} {"max":>8} {"reads":>6}')
+    tuned_journal_mode, tuned_pragmas = Database.JOURNAL_MODE, Database.PRAGMAS
+    for name, journal_mode, pragmas in ( ( 'rollback journal', 'DELETE', {} ), ( 'wal, tuned pragmas', tuned_journal_mode, tuned_pragmas ) ):
+        Database.JOURNAL_MODE, Database.PRAGMAS = journal_mode, pragmas
+        database = create_database()
+        database.store_wish_history(create_wishes(args.wishes))
+        median, p99, maximum, reads = measure_concurrent_reads(database, args.batches, args.batch_size)
+        print(f'{name:>26}  {median * 1000:6.2f}ms {p99 * 1000:6.2f}ms {maximum * 1000:6.2f}ms {reads:>6}')
+        database.close()
+
+
+if __name__ == '__main__':
+    main()
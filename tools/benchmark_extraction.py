@@ -0,0 +1,80 @@
+# compare finding the wish history url in a large synthetic web cache
+# file by reading and scanning all of it, with the memory-mapped reverse
+# search the client uses. every method runs in its own process, so the
+# peak memory usage of one doesn't hide that of the other (unix only)
+#
+#   python tools/benchmark_extraction.py --size 128
+
+import argparse
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import monotonic
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from wishing_well.client import Client  # noqa: E402
+
+URL = b'https://webstatic-sea.hoyoverse.com/genshin/event/e20190909gacha-v2/index.html?authkey_ver=1&authkey=%s&game_biz=hk4e_global\0'
+
+
+def create_cache_file(path, size_mb):
+    # random binary data with an old url near the start and the current
+    # one close to the end, roughly like a cache that has been in use a while
+    chunk = os.urandom(1024 * 1024).replace(b'\0', b'\1')
+    with path.open('wb') as fp:
+        fp.write(URL % b'old')
+        for _ in range(size_mb):
+            fp.write(chunk)
+        fp.write(URL % b'current')
+        fp.write(chunk[:4096])
+
+
+def read_and_search(path):
+    with path.open('rb') as fp:
+        cache_file = fp.read()
+
+    matches = re.compile(b'(https://webstatic-sea.hoyoverse.com/genshin/event/.+?)\0').findall(cache_file)
+    return matches[-1].decode('utf-8') if len(matches) > 0 else None
+
+
+def run(method, path):
+    start = monotonic()
+    url = read_and_search(path) if method == 'read' else Client._find_last_auth_token_url(path)
+    duration = monotonic() - start
+
+    # kilobytes on linux, bytes on macos
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    print(f'{duration} {peak_rss} {url}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark extracting the wish history url from a synthetic web cache file.')
+    parser.add_argument('--size', type=int, default=128, help='size of the cache file in megabytes')
+    parser.add_argument('--run', nargs=2, metavar=('METHOD', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(args.run[0], Path(args.run[1]))
+        return
+
+    with tempfile.TemporaryDirectory(prefix='wishing-well-benchmark-') as directory:
+        path = Path(directory) / 'data_2'
+        create_cache_file(path, args.size)
+
+        print(f'{"method":>6} {"time":>8} {"peak rss":>10}  url found')
+        for method in ( 'read', 'mmap' ):
+            output = subprocess.check_output([ sys.executable, __file__, '--run', method, str(path) ], text=True)
+            duration, peak_rss, url = output.strip().split(' ', 2)
+            found = 'yes' if url.endswith('authkey=current&game_biz=hk4e_global') else 'no'
+            print(f'{method:>6} {float(duration):>7.3f}s {int(peak_rss) / 1024:>8.1f}MB  {found}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# measure how fast the client refreshes a wish history from the local
+# stand-in api, at different concurrency levels and request rates. with
+# --cert, the stub serves https; compare with --fresh-connections to see
+# what reusing connections saves on tcp and tls handshakes.
+#
+#   python tools/benchmark_fetch.py --wishes 2000 --latency 0.05 --concurrency 1 2 4
+#   python tools/benchmark_fetch.py --cert stub.pem --fresh-connections
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from pathlib import Path
+from time import monotonic
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from stub_api import StubAPI, generate_fixture  # noqa: E402
+from wishing_well.client import Client  # noqa: E402
+from wishing_well.connection_pool import ConnectionPool  # noqa: E402
+from wishing_well.rate_limiter import RateLimiter  # noqa: E402
+
+
+def benchmark(stub, concurrency, rate):
+    # every run gets a fresh data directory, and thus a fresh database
+    data_path = tempfile.mkdtemp(prefix='wishing-well-benchmark-')
+    os.environ['XDG_DATA_HOME'] = data_path
+    os.environ['APPDATA'] = data_path
+
+    Client.API_BASE_URL = stub.base_url
+    Client._page_sizes.clear()
+    latencies = []
+
+    def on_progress(event, **data):
+        if event == 'request':
+            latencies.append(data['latency'])
+
+    client = Client(max_concurrent_banners=concurrency, rate_limiter=RateLimiter(rate=rate, max_rate=rate * 2), progress_callback=on_progress)
+    client.set_region_and_auth_token('os_euro', 'benchmark')
+
+    results = {}
+    for name in ( 'full', 'incremental' ):
+        stub.request_count = 0
+        latencies.clear()
+        start = monotonic()
+        client.fetch_and_store_banner_types()
+        new_wishes_count = client.fetch_and_store_wish_history()
+        duration = monotonic() - start
+        results[name] = ( duration, stub.request_count, sum(latencies) / max(len(latencies), 1), new_wishes_count )
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark wish history refreshes against the local stand-in api.')
+    parser.add_argument('--wishes', type=int, default=1000, help='synthetic wishes per banner type')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stub waits before every response')
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--max-page-size', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=10, help='initial request rate of the client')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[ 1, 2, 4 ])
+    parser.add_argument('--cert', help='serve https, with the certificate and key in this pem file')
+    parser.add_argument('--fresh-connections', action='store_true', help='open a new connection for every request')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    stub = StubAPI(generate_fixture(args.wishes), latency=args.latency, throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate, max_page_size=args.max_page_size, cert=args.cert).start()
+    if args.cert is not None:
+        os.environ['SSL_CERT_FILE'] = args.cert
+    if args.fresh_connections:
+        Client._connection_pool = ConnectionPool(max_idle_per_host=0)
+
+    print(f'{"concurrency":>11} {"refresh":>12} {"time":>8} {"requests":>9} {"pages/s":>8} {"latency":>9} {"wishes":>7}')
+    for concurrency in args.concurrency:
+        for name, ( duration, requests, latency, wishes ) in benchmark(stub, concurrency, args.rate).items():
+            print(f'{concurrency:>11} {name:>12} {duration:>7.2f}s {requests:>9} {requests / duration:>8.1f} {latency * 1000:>7.2f}ms {wishes:>7}')
+
+    stub.stop()
+
+
+if __name__ == '__main__':
+    main()
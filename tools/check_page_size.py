@@ -0,0 +1,131 @@
+# check the page size negotiation against the local stand-in api: whether
+# the largest usable size is found when the api truncates larger pages and
+# when it rejects them, that the whole wish history is fetched either way,
+# and that failed requests are never taken for a rejected page size.
+# exits with a non-zero status if any check fails
+#
+#   python tools/check_page_size.py
+
+import logging
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from stub_api import StubAPI, generate_fixture  # noqa: E402
+from wishing_well.client import Client  # noqa: E402
+from wishing_well.exceptions import EndpointError  # noqa: E402
+from wishing_well.rate_limiter import RateLimiter  # noqa: E402
+from wishing_well.retry_policy import RetryPolicy  # noqa: E402
+
+WISHES = 130  # per banner type, except for the novice wishes
+# a port nothing listens on, to make every request fail
+CLOSED_BASE_URL = 'http://localhost:9/event/gacha_info/api/'
+
+
+def create_client(base_url, stored_page_size=None):
+    # every client gets a fresh data directory, and thus a fresh database
+    data_path = tempfile.mkdtemp(prefix='wishing-well-check-')
+    os.environ['XDG_DATA_HOME'] = data_path
+    os.environ['APPDATA'] = data_path
+
+    Client.API_BASE_URL = base_url
+    Client._page_sizes.clear()
+    no_retries = RetryPolicy(max_retries=0)
+    client = Client(
+        rate_limiter=RateLimiter(rate=1000, max_rate=1000, base_backoff=0, max_backoff=0),
+        retry_policies={ 'getGachaLog': no_retries, 'getConfigList': no_retries })
+    client.set_region_and_auth_token('os_euro', 'check')
+    if stored_page_size is not None:
+        client.database.store_meta('page_size_os_euro', stored_page_size)
+    return client
+
+
+# a size negotiated on a short wish history, like that of the novice
+# wishes, is used but not stored, so the stored size may be missing
+def check_fetch(max_page_size, reject_large_pages, expected_page_size, stored_page_size=None):
+    fixture = generate_fixture(WISHES)
+    stub = StubAPI(fixture, max_page_size=max_page_size, reject_large_pages=reject_large_pages).start()
+    try:
+        client = create_client(stub.base_url, stored_page_size)
+        client.fetch_and_store_banner_types()
+        new_wishes = client.fetch_and_store_wish_history()
+    finally:
+        stub.stop()
+
+    page_size = Client._page_sizes.get('os_euro')
+    stored = client.database.get_meta('page_size_os_euro')
+    expected_wishes = sum(len(wishes) for wishes in fixture['wishes'].values())
+    errors = []
+    if page_size != expected_page_size:
+        errors.append(f'page size is {page_size}, expected {expected_page_size}')
+    if stored is not None and int(stored) != expected_page_size:
+        errors.append(f'stored page size is {stored}, expected {expected_page_size}')
+    if new_wishes != expected_wishes:
+        errors.append(f'fetched {new_wishes} of {expected_wishes} wishes')
+    return errors
+
+
+# the banner types are fetched first with a working stub, then
+# every request for the wish history fails the given way
+def check_failure(stub_options, stored_page_size=None):
+    stub = StubAPI(generate_fixture(WISHES)).start()
+    try:
+        client = create_client(stub.base_url, stored_page_size)
+        client.fetch_and_store_banner_types()
+    finally:
+        stub.stop()
+
+    failing_stub = None
+    if stub_options is None:
+        Client.API_BASE_URL = CLOSED_BASE_URL
+    else:
+        failing_stub = StubAPI(generate_fixture(WISHES), **stub_options).start()
+        Client.API_BASE_URL = failing_stub.base_url
+
+    errors = []
+    try:
+        client.fetch_and_store_wish_history()
+        errors.append('the refresh did not fail')
+    except EndpointError:
+        pass
+    finally:
+        if failing_stub is not None:
+            failing_stub.stop()
+
+    stored = client.database.get_meta('page_size_os_euro')
+    if stored is not None and (stored_page_size is None or int(stored) != stored_page_size):
+        errors.append(f'stored page size is {stored}, expected {stored_page_size}')
+    return errors
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+
+    checks = [
+        ( 'truncated above 20', lambda: check_fetch(20, False, 20) ),
+        ( 'truncated above 50', lambda: check_fetch(50, False, 50) ),
+        ( 'truncated above 100', lambda: check_fetch(100, False, 100) ),
+        ( 'rejected above 20', lambda: check_fetch(20, True, 20) ),
+        ( 'rejected above 50', lambda: check_fetch(50, True, 50) ),
+        # a stored size that is rejected later on falls back to the default size
+        ( 'rejected above 50, 100 stored', lambda: check_fetch(50, True, 20, stored_page_size=100) ),
+        ( 'connection refused', lambda: check_failure(None) ),
+        ( 'server errors', lambda: check_failure({ 'error_rate': 1 }) ),
+        ( 'throttled', lambda: check_failure({ 'throttle_rate': 1 }) ),
+        ( 'server errors, 100 stored', lambda: check_failure({ 'error_rate': 1 }, stored_page_size=100) ),
+    ]
+
+    failed = False
+    for name, check in checks:
+        errors = check()
+        print(f'{name:>30}: {"ok" if len(errors) == 0 else "; ".join(errors)}')
+        failed = failed or len(errors) > 0
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
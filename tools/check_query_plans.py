@@ -0,0 +1,179 @@
+# check that every query Database makes is answered through an index. a
+# database of the first version, filled with some wishes, is migrated to
+# the current version, every Database method is called on it, and all
+# statements that read rows are traced and run again through EXPLAIN QUERY
+# PLAN. a plan that scans a table without an index fails, unless the query
+# is meant to read the whole table, and so does an index search that does
+# not narrow down every column the query compares for equality. sorting without an index is fine for
+# the few rows that are left after an index search, like fetch cursors.
+# exits with a non-zero status if any check fails
+#
+#   python tools/check_query_plans.py
+
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+from threading import Lock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from wishing_well.database import DATABASE_VERSION, Database  # noqa: E402
+from wishing_well.enums import ItemType  # noqa: E402
+
+UID = 700000000
+BANNER_TYPES = ( 100, 200, 301, 302 )
+WISHES = 2000  # per banner type
+
+# queries that read all rows of a table on purpose
+FULL_TABLE_READS = (
+    'SELECT id, name FROM banner_types',
+)
+
+
+# the schema of the first database version, as it was created back then
+def create_version_1_database(path):
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, data BLOB)')
+    connection.execute('CREATE TABLE banner_types (id INTEGER PRIMARY KEY, name TEXT)')
+    connection.execute('''
+        CREATE TABLE wish_history (
+            id INTEGER,
+            uid INTEGER,
+            banner_type INTEGER,
+            type ITEM_TYPE,
+            rarity INTEGER,
+            time TEXT,
+            name TEXT,
+            UNIQUE (id, uid)
+        )
+    ''')
+    connection.execute('INSERT INTO meta VALUES ("version", 1)')
+    connection.executemany('INSERT INTO banner_types VALUES (?, ?)', [ ( banner_type, f'Banner {banner_type}' ) for banner_type in BANNER_TYPES ])
+    connection.executemany('INSERT INTO wish_history VALUES (?, ?, ?, ?, ?, ?, ?)', [
+        ( 1000000000 + i * len(BANNER_TYPES) + n, UID, banner_type, 1, 3, f'2022-01-01 00:{i // 60 % 60:02}:{i % 60:02}', 'Wish' )
+        for n, banner_type in enumerate(BANNER_TYPES) for i in range(WISHES)
+    ])
+    connection.commit()
+    connection.close()
+
+
+# records every statement run on a connection of the database
+class TracedDatabase(Database):
+    statements = []
+    _statements_lock = Lock()
+
+    def _connect(self):
+        connection = super()._connect()
+        connection.set_trace_callback(self._trace)
+        return connection
+
+    @classmethod
+    def _trace(cls, statement):
+        with cls._statements_lock:
+            cls.statements.append(statement)
+
+
+def exercise(database):
+    wish = {
+        'id': 2000000000,
+        'uid': UID,
+        'banner_type': 301,
+        'type': ItemType.CHARACTER,
+        'rarity': 5,
+        'time': '2022-02-01 00:00:00',
+        'name': 'Wish'
+    }
+    fetch_cursor = { 'uid': UID, 'banner_type': 301, 'end_id': 1500000000, 'target_id': 1000000000 }
+
+    database.get_meta('version')
+    database.store_meta('check', 1)
+    database.get_banner_types()
+    database.store_banner_types([ { 'key': 400, 'name': 'Banner 400' } ])
+    list(database.get_uids())
+    list(database.get_wish_history(UID))
+    database.get_latest_wish_id(UID, 301)
+    database.get_latest_wish_id(UID, 301, 1500000000)
+    database.get_wish_ids(UID, 301, 1000000000)
+    database.get_wish_ids(UID, 301, 1000000000, 1500000000)
+    database.store_verified_range(UID, 301, 1000000000, 1500000000)
+    database.get_verified_range(UID, 301)
+    database.store_fetch_cursors([ fetch_cursor ])
+    database.get_fetch_cursors(UID, 301)
+    database.store_wish_history([ wish ], fetch_cursor)
+    database.store_wish_history([], fetch_cursor | { 'end_id': None })
+    database.back_up()
+
+
+def is_query(statement):
+    return statement.split(None, 1)[0].upper() in ( 'SELECT', 'UPDATE', 'DELETE' )
+
+
+def check_plan(connection, statement):
+    plan = [ row[3] for row in connection.execute(f'EXPLAIN QUERY PLAN {statement}') ]
+    template = ' '.join(statement.split())
+    if any(template.startswith(query) for query in FULL_TABLE_READS):
+        return plan, []
+
+    # an index only helps if it's searched by the columns the query filters on
+    where = template.upper().partition(' WHERE ')[2]
+    equal_columns = set(re.findall(r'\b(\w+) = ', where.lower()))
+    searched_columns = set()
+    for detail in plan:
+        constraints = re.search(r'\((.*)\)$', detail)
+        if detail.startswith('SEARCH') and constraints is not None:
+            searched_columns |= set(re.findall(r'(\w+)[=<>]', constraints.group(1)))
+
+    errors = []
+    for detail in plan:
+        if detail.startswith('SCAN') and 'COVERING INDEX' not in detail:
+            errors.append(detail)
+    if not equal_columns <= searched_columns:
+        errors.append(f'not searched by {", ".join(sorted(equal_columns - searched_columns))}')
+    if not any(detail.startswith('SEARCH') or 'COVERING INDEX' in detail for detail in plan):
+        errors.append('no index used')
+    return plan, errors
+
+
+def main():
+    data_path = tempfile.mkdtemp(prefix='wishing-well-check-')
+    os.environ['XDG_DATA_HOME'] = data_path
+    os.environ['APPDATA'] = data_path
+    database_path = Path(data_path) / 'wishing-well' / 'database.sqlite3'
+    database_path.parent.mkdir()
+    create_version_1_database(database_path)
+
+    database = TracedDatabase()
+    version = database.get_meta('version')
+    if version != DATABASE_VERSION:
+        print(f'The database was migrated to version {version}, expected {DATABASE_VERSION}')
+        sys.exit(1)
+    exercise(database)
+    database.close()
+
+    # the plans of the migrated database, not of one that was created fresh
+    connection = sqlite3.connect(database_path)
+    failed = False
+    checked = set()
+    for statement in TracedDatabase.statements:
+        statement = statement.strip()
+        if not is_query(statement) or statement in checked:
+            continue
+        checked.add(statement)
+
+        plan, errors = check_plan(connection, statement)
+        print(' '.join(statement.split()))
+        for detail in plan:
+            print(f'    {detail}')
+        if len(errors) > 0:
+            print(f'    FAILED: {"; ".join(errors)}')
+            failed = True
+    connection.close()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
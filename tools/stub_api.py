@@ -0,0 +1,245 @@
+# a local stand-in for the gacha_info api, so the client can be exercised and
+# benchmarked without the live service. it serves getConfigList and getGachaLog
+# with end_id paging from a synthetic or recorded wish history, and can add
+# latency, throttle retcodes and server errors on request. page sizes above
+# --max-page-size are truncated, or rejected with --reject-large-pages.
+# with --cert, the stub serves https, so tls handshakes are part of what's
+# measured. the certificate has to be trusted through SSL_CERT_FILE
+#
+#   python tools/stub_api.py --wishes 1000 --latency 0.05
+#   WISHING_WELL_API_BASE_URL=http://localhost:39100/event/gacha_info/api/ python wishing-well.py
+#
+#   openssl req -x509 -newkey rsa:2048 -nodes -days 30 -subj /CN=localhost \
+#       -addext subjectAltName=DNS:localhost -keyout stub.pem -out stub.pem
+#   python tools/stub_api.py --cert stub.pem
+#   SSL_CERT_FILE=stub.pem WISHING_WELL_API_BASE_URL=https://localhost:39100/event/gacha_info/api/ python wishing-well.py
+
+import argparse
+import json
+import random
+import sqlite3
+import ssl
+import sys
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import urlparse, parse_qs
+
+
+BANNER_TYPES = {
+    100: 'Novice Wishes',
+    200: 'Permanent Wish',
+    301: 'Character Event Wish',
+    302: 'Weapon Event Wish'
+}
+
+
+# a fixture is a dict with the uid, the banner types, and the
+# wishes of every banner type, newest first, like the api returns them
+def generate_fixture(wishes_per_banner, uid=700000000, seed=0):
+    rng = random.Random(seed)
+    time = datetime(2022, 1, 1)
+    id_ = 1640000000000000000
+    wishes = { str(banner_type): [] for banner_type in BANNER_TYPES }
+    for banner_type in BANNER_TYPES:
+        count = min(wishes_per_banner, 20) if banner_type == 100 else wishes_per_banner
+        for _ in range(count):
+            id_ += rng.randint(1, 1000)
+            time += timedelta(seconds=rng.randint(1, 3600))
+            rarity = rng.choices(( 3, 4, 5 ), weights=( 94, 5, 1 ))[0]
+            item_type = 'Weapon' if rarity == 3 or rng.random() < 0.5 else 'Character'
+            wishes[str(banner_type)].append({
+                'uid': str(uid),
+                'gacha_type': str(banner_type),
+                'item_id': '',
+                'count': '1',
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'name': f'{item_type} {rng.randint(1, 50)}',
+                'lang': 'en-us',
+                'item_type': item_type,
+                'rank_type': str(rarity),
+                'id': str(id_)
+            })
+
+    for banner_wishes in wishes.values():
+        banner_wishes.reverse()
+
+    return {
+        'uid': uid,
+        'banner_types': { str(key): name for key, name in BANNER_TYPES.items() },
+        'wishes': wishes
+    }
+
+# record a fixture from the wish history of a uid in a wishing well database
+def record_fixture(database_path, uid):
+    connection = sqlite3.connect(database_path)
+    banner_types = dict(connection.execute('SELECT id, name FROM banner_types').fetchall())
+    wishes = { str(banner_type): [] for banner_type in banner_types }
+    for id_, banner_type, type_, rarity, time, name in connection.execute('''
+        SELECT id, banner_type, type, rarity, time, name FROM wish_history WHERE uid = ? ORDER BY id DESC
+    ''', (uid,)):
+        wishes.setdefault(str(banner_type), []).append({
+            'uid': str(uid),
+            'gacha_type': str(banner_type),
+            'item_id': '',
+            'count': '1',
+            'time': time,
+            'name': name,
+            'lang': 'en-us',
+            'item_type': 'Character' if int(type_) == 2 else 'Weapon',
+            'rank_type': str(rarity),
+            'id': str(id_)
+        })
+    connection.close()
+
+    return {
+        'uid': uid,
+        'banner_types': { str(key): name for key, name in banner_types.items() },
+        'wishes': wishes
+    }
+
+
+class StubAPI:
+    def __init__(self, fixture, port=0, latency=0, throttle_rate=0, error_rate=0, max_page_size=20, reject_large_pages=False, cert=None):
+        self.fixture = fixture
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.max_page_size = max_page_size
+        self.reject_large_pages = reject_large_pages
+        self.request_count = 0
+        self._lock = Lock()
+
+        stub = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, don't let them wait for an ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub._handle(self)
+
+        self._server = ThreadingHTTPServer(('localhost', port), RequestHandler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+        # cert is a pem file with both the certificate and its key. the
+        # handshake happens in the request thread, not when accepting
+        self._scheme = 'http'
+        if cert is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert)
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True, do_handshake_on_connect=False)
+            self._scheme = 'https'
+
+    @property
+    def base_url(self):
+        return f'{self._scheme}://localhost:{self._server.server_port}/event/gacha_info/api/'
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _respond(self, handler, status, body):
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _handle(self, handler):
+        with self._lock:
+            self.request_count += 1
+
+        if self.latency > 0:
+            sleep(self.latency)
+
+        if random.random() < self.error_rate:
+            self._respond(handler, 500, b'')
+            return
+
+        url = urlparse(handler.path)
+        params = { key: values[0] for key, values in parse_qs(url.query).items() }
+        if random.random() < self.throttle_rate:
+            result = { 'retcode': -110, 'message': 'visit too frequently', 'data': None }
+        elif 'authkey' not in params:
+            result = { 'retcode': -100, 'message': 'authkey error', 'data': None }
+        elif url.path.endswith('/getConfigList'):
+            result = { 'retcode': 0, 'message': 'OK', 'data': {
+                'gacha_type_list': [
+                    { 'id': key, 'key': key, 'name': name } for key, name in self.fixture['banner_types'].items()
+                ],
+                'region': 'os_euro'
+            } }
+        elif url.path.endswith('/getGachaLog') and self.reject_large_pages and int(params.get('size', 20)) > self.max_page_size:
+            result = { 'retcode': -1, 'message': 'size too large', 'data': None }
+        elif url.path.endswith('/getGachaLog'):
+            wishes = self.fixture['wishes'].get(params.get('gacha_type'), [])
+            end_id = int(params.get('end_id', 0) or 0)
+            size = min(int(params.get('size', 20)), self.max_page_size)
+            start = 0
+            if end_id > 0:
+                while start < len(wishes) and int(wishes[start]['id']) >= end_id:
+                    start += 1
+
+            result = { 'retcode': 0, 'message': 'OK', 'data': {
+                'page': '0',
+                'size': str(size),
+                'total': '0',
+                'list': wishes[start:start + size],
+                'region': 'os_euro'
+            } }
+        else:
+            self._respond(handler, 404, b'')
+            return
+
+        self._respond(handler, 200, json.dumps(result).encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the gacha_info api.')
+    parser.add_argument('--port', type=int, default=39100)
+    parser.add_argument('--wishes', type=int, default=500, help='synthetic wishes per banner type')
+    parser.add_argument('--fixture', help='serve the wish history from this fixture file instead')
+    parser.add_argument('--record', nargs=3, metavar=( 'DATABASE', 'UID', 'FIXTURE' ), help='record a fixture from a database and exit')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before every response')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='share of requests answered with "visit too frequently"')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered with http 500')
+    parser.add_argument('--max-page-size', type=int, default=20)
+    parser.add_argument('--reject-large-pages', action='store_true', help='reject larger page sizes instead of truncating them')
+    parser.add_argument('--cert', help='serve https, with the certificate and key in this pem file')
+    args = parser.parse_args()
+
+    if args.record is not None:
+        database_path, uid, fixture_path = args.record
+        with open(fixture_path, 'w', encoding='utf-8') as fp:
+            json.dump(record_fixture(database_path, int(uid)), fp)
+        return
+
+    if args.fixture is not None:
+        with open(args.fixture, 'r', encoding='utf-8') as fp:
+            fixture = json.load(fp)
+    else:
+        fixture = generate_fixture(args.wishes)
+
+    stub = StubAPI(fixture, args.port, args.latency, args.throttle_rate, args.error_rate, args.max_page_size, args.reject_large_pages, args.cert)
+    print(f'Serving on {stub.base_url}')
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        stub.stop()
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
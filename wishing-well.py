@@ -12,6 +12,7 @@
 #     nuitka-project: --windows-product-version=1.4.0
 
 import logging
+import sys
 import bottle
 
 from wishing_well.util import set_up_logging, get_usable_port
@@ -19,5 +20,5 @@ from wishing_well.server import Server
 
 set_up_logging()
 port = get_usable_port()
-Server(bottle, port)
+Server(bottle, port, watch='--watch' in sys.argv[1:])
 logging.info('Quitting')
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+
+from .client import Client
+from .rate_limiter import RateLimiter
+
+
+# hands all writes to the database to a single task on the event loop,
+# so concurrently updated accounts and banner types never contend for
+# sqlite's write lock. reads are passed through to the database as-is.
+# write methods must be called from worker threads, never from the loop
+class DatabaseWriter:
+    WRITE_METHODS = ( 'store_banner_types', 'store_wish_history', 'store_fetch_cursors', 'store_verified_range', 'store_meta' )
+
+    def __init__(self, database):
+        self._database = database
+        self._loop = None
+        self._queue = None
+        self._task = None
+        self._executor = None
+
+    async def __aenter__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._task = asyncio.create_task(self._write())
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        await self._queue.put(None)
+        await self._task
+        self._executor.shutdown()
+
+        # to not ignore any exceptions that happened inside a with block
+        return False
+
+    async def _write(self):
+        while (write := await self._queue.get()) is not None:
+            method, args, kwargs, future = write
+            try:
+                # writes run one after another on their own thread, so they
+                # neither block the event loop, nor wait for a free worker
+                # thread that is itself waiting for a write to finish
+                future.set_result(await self._loop.run_in_executor(self._executor, partial(method, *args, **kwargs)))
+            except Exception as e:
+                future.set_exception(e)
+
+    async def _submit(self, method, args, kwargs):
+        future = self._loop.create_future()
+        await self._queue.put((method, args, kwargs, future))
+        return await future
+
+    def __getattr__(self, name):
+        attribute = getattr(self._database, name)
+        if name not in self.WRITE_METHODS:
+            return attribute
+
+        def write(*args, **kwargs):
+            return asyncio.run_coroutine_threadsafe(self._submit(attribute, args, kwargs), self._loop).result()
+
+        return write
+
+
+# an asyncio variant of the client. requests and database reads run on
+# worker threads, writes go through a DatabaseWriter. all async clients
+# share one rate limiter, so refreshing several accounts at once does
+# not multiply the request rate towards the api
+class AsyncClient(Client):
+    _shared_rate_limiter = RateLimiter()
+
+    def __init__(self, database_writer, max_concurrent_banners=Client.MAX_CONCURRENT_BANNERS, pages_per_batch=Client.PAGES_PER_BATCH, progress_callback=None):
+        super().__init__(max_concurrent_banners, pages_per_batch, rate_limiter=self._shared_rate_limiter, database=database_writer,
+            progress_callback=progress_callback)
+        self._banner_semaphore = asyncio.Semaphore(max_concurrent_banners)
+
+    async def fetch_and_store_banner_types(self, force=False):
+        await asyncio.to_thread(super().fetch_and_store_banner_types, force)
+
+    async def _fetch_and_store_banner_wish_history_async(self, banner_type, verify):
+        async with self._banner_semaphore:
+            return await asyncio.to_thread(self._fetch_and_store_banner_wish_history, banner_type, verify)
+
+    async def fetch_and_store_wish_history(self, verify=False):
+        logging.info('Fetching wish history')
+        banner_types = await asyncio.to_thread(self._database.get_banner_types)
+        new_wishes_counts = await asyncio.gather(*(
+            self._fetch_and_store_banner_wish_history_async(banner_type, verify) for banner_type in banner_types
+        ))
+
+        self._log_request_stats()
+        return sum(new_wishes_counts)
+
+
+# update the banner types and wish histories of several accounts at once.
+# tokens is a list of (region, auth token) tuples. returns a result for
+# every account: its uid (if it could be determined), the number of new
+# wishes, how long the update took, and the exception it ended with.
+# progress_callbacks, if given, has a progress callback for every account
+async def update_accounts(database, tokens, verify=False, progress_callbacks=None):
+    async def update_account(writer, region, auth_token, progress_callback):
+        client = AsyncClient(writer, progress_callback=progress_callback)
+        client.set_region_and_auth_token(region, auth_token)
+        start = monotonic()
+        new_wishes_count = 0
+        error = None
+        try:
+            await client.fetch_and_store_banner_types()
+            new_wishes_count = await client.fetch_and_store_wish_history(verify)
+        except Exception as e:
+            error = e
+
+        return {
+            'uid': client.uid,
+            'new_wishes': new_wishes_count,
+            'duration': monotonic() - start,
+            'error': error
+        }
+
+    if progress_callbacks is None:
+        progress_callbacks = [ None ] * len(tokens)
+
+    async with DatabaseWriter(database) as writer:
+        return await asyncio.gather(*(
+            update_account(writer, region, auth_token, progress_callback)
+            for ( region, auth_token ), progress_callback in zip(tokens, progress_callbacks)
+        ))
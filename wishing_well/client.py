@@ -1,25 +1,94 @@
+import hashlib
 import json
 import logging
-import re
+import mmap
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
 from json.decoder import JSONDecodeError
-from time import sleep
-from urllib.error import URLError, HTTPError
-from urllib.request import urlopen
+from threading import Lock
+from time import monotonic, time
 from urllib.parse import urlparse, urlencode, parse_qs
 
+from .connection_pool import ConnectionPool
 from .enums import ItemType
-from .exceptions import AuthTokenExtractionError, LogNotFoundError, MissingAuthTokenError, EndpointError, RequestError
+from .rate_limiter import RateLimiter
+from .retry_policy import RetryPolicy
+from .exceptions import AuthTokenExtractionError, AuthTokenExpiredError, LogNotFoundError, MissingAuthTokenError, EndpointError, RequestError, RequestRejectedError
 from .database import Database
-from .util import get_cache_path
+from .util import copy_cache_file, find_cache_file, get_game_path, get_state, set_state
 
 
 class Client:
-    API_BASE_URL = 'https://hk4e-api-os.hoyoverse.com/event/gacha_info/api/'
-
-    def __init__(self):
+    API_BASE_URL = os.environ.get('WISHING_WELL_API_BASE_URL', 'https://hk4e-api-os.hoyoverse.com/event/gacha_info/api/')
+    MAX_CONCURRENT_BANNERS = 4
+    PAGES_PER_BATCH = 5
+    THROTTLE_RETCODES = ( -110, )  # "visit too frequently"
+    AUTH_TOKEN_EXPIRED_RETCODES = ( -101, )  # "authkey timeout"
+    # keyword arguments of the retry policy per endpoint. backfills of long wish
+    # histories take many pages, so they get to wait out flaky connections longer
+    RETRY_POLICIES = {
+        'getConfigList': { 'time_budget': 30 },
+        'getGachaLog': { 'time_budget': 120 }
+    }
+    DEFAULT_PAGE_SIZE = 20
+    PAGE_SIZES = ( 100, 50, DEFAULT_PAGE_SIZE )  # largest first
+    BANNER_TYPES_TTL = 7 * 24 * 60 * 60  # seconds
+    AUTH_TOKEN_URL_PREFIX = b'https://webstatic-sea.hoyoverse.com/genshin/event/'
+    READ_CACHE_FILE_IN_PLACE = sys.platform != 'win32'
+
+    # shared by all clients, so connections are reused across pages, banner types and clients
+    _connection_pool = ConnectionPool()
+
+    # largest page size the api accepts, per region
+    _page_sizes = {}
+    _page_size_lock = Lock()
+
+    # all banner types are fetched concurrently, but share
+    # a single rate limiter as their request budget
+    # the progress callback, if given, is called with an event name and keyword arguments:
+    # 'request' (endpoint, latency), 'page' (banner_type, wishes) and 'banner' (banner_type, new_wishes).
+    # retry_policies maps endpoints to RetryPolicy instances, overriding RETRY_POLICIES
+    def __init__(self, max_concurrent_banners=MAX_CONCURRENT_BANNERS, pages_per_batch=PAGES_PER_BATCH, rate_limiter=None, database=None, progress_callback=None, retry_policies=None):
         self._region = None
         self._auth_token = None
-        self._database = Database()
+        self._uid = None
+        self._database = database if database is not None else Database()
+        self._max_concurrent_banners = max_concurrent_banners
+        self._pages_per_batch = pages_per_batch
+        self._rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self._progress_callback = progress_callback
+        self._retry_policies = { endpoint: RetryPolicy(**kwargs) for endpoint, kwargs in self.RETRY_POLICIES.items() }
+        if retry_policies is not None:
+            self._retry_policies.update(retry_policies)
+        self._default_retry_policy = RetryPolicy()
+        self._known_gacha_types = None
+        # gacha types that were still unknown after refreshing the banner types
+        self._unresolved_gacha_types = set()
+        self._banner_types_lock = Lock()
+
+    @property
+    def rate_limiter(self):
+        return self._rate_limiter
+
+    # endpoint -> kind of error -> { 'retries': ..., 'wait': seconds }
+    @property
+    def retry_stats(self):
+        return { endpoint: policy.stats for endpoint, policy in self._retry_policies.items() if len(policy.stats) > 0 }
+
+    @property
+    def database(self):
+        return self._database
+
+    # the uid of the current auth token, known after fetching the first wish
+    @property
+    def uid(self):
+        return self._uid
+
+    def _report_progress(self, event, **data):
+        if self._progress_callback is not None:
+            self._progress_callback(event, **data)
 
     def _request(self, endpoint, extra_params=None):
         if self._region is None or self._auth_token is None:
@@ -33,95 +102,435 @@ class Client:
         if extra_params is not None:
             params = params | extra_params
 
-        logging.info('Requesting endpoint %s', endpoint)
-        try:
-            with urlopen('{}{}?{}'.format(self.API_BASE_URL, endpoint, urlencode(params))) as request:
-                result = request.read()
-        except (URLError, HTTPError) as err:
-            logging.error(err)
-            raise EndpointError('Error making request.')
-
-        try:
-            result = json.loads(result)
-        except JSONDecodeError as err:
-            logging.error(err)
-            raise RequestError('Error parsing request result as JSON.')
-
-        if 'retcode' not in result:
-            logging.error('Response had no "retcode" field')
-            raise EndpointError('Malformed response from endpoint.')
-
-        if result['retcode'] != 0:
-            pretty_message = result['message'][0].upper() + result['message'][1:] + '.'
-            logging.error(pretty_message)
-            raise EndpointError(pretty_message)
+        url = '{}{}?{}'.format(self.API_BASE_URL, endpoint, urlencode(params))
+        retry_policy = self._retry_policies.get(endpoint, self._default_retry_policy)
+        started_at = monotonic()
+        retries = 0
+        while True:
+            self._rate_limiter.acquire()
+            logging.info('Requesting endpoint %s', endpoint)
+            request_start = monotonic()
+            try:
+                status, result = self._connection_pool.get(url)
+            except (HTTPException, OSError) as err:
+                logging.error(err)
+                self._rate_limiter.throttle()
+                if retry_policy.backoff('network', retries, started_at):
+                    retries += 1
+                    continue
+                raise EndpointError('Error making request.')
+
+            latency = monotonic() - request_start
+            logging.debug('Request to %s took %.3fs', endpoint, latency)
+            self._report_progress('request', endpoint=endpoint, latency=latency)
+            if status >= 400:
+                logging.error('HTTP error %d', status)
+                self._rate_limiter.throttle()
+                if (status >= 500 or status == 429) and retry_policy.backoff('server' if status >= 500 else 'throttle', retries, started_at):
+                    retries += 1
+                    continue
+                raise EndpointError('Error making request.')
+
+            try:
+                result = json.loads(result)
+            except JSONDecodeError as err:
+                logging.error(err)
+                raise RequestError('Error parsing request result as JSON.')
+
+            if 'retcode' not in result:
+                logging.error('Response had no "retcode" field')
+                raise EndpointError('Malformed response from endpoint.')
+
+            if result['retcode'] in self.THROTTLE_RETCODES:
+                self._rate_limiter.throttle()
+                if retry_policy.backoff('throttle', retries, started_at):
+                    retries += 1
+                    continue
+                raise EndpointError('Too many requests, try again later.')
+
+            if result['retcode'] in self.AUTH_TOKEN_EXPIRED_RETCODES:
+                logging.error('Auth token has expired')
+                raise AuthTokenExpiredError('The auth token has expired. Open the wish history in the game, then try again.')
+
+            # the api understood the request, but refused it
+            if result['retcode'] != 0:
+                pretty_message = result['message'][0].upper() + result['message'][1:] + '.'
+                logging.error(pretty_message)
+                raise RequestRejectedError(pretty_message)
+
+            self._rate_limiter.success()
+            break
 
         return result['data']
 
-    def _fetch_wish_history(self, banner_type, end_id=None):
+    # try page sizes from largest to smallest, until the api neither rejects
+    # the size nor truncates the list. returns the page size, and whether
+    # it's certain; a short wish history tells us nothing about the limit
+    def _negotiate_page_size(self, banner_type):
+        for size in self.PAGE_SIZES:
+            if size <= self.DEFAULT_PAGE_SIZE:
+                break
+
+            params = { 'gacha_type': banner_type, 'size': size }
+            try:
+                page = self._request('getGachaLog', params)['list']
+                if len(page) == size:
+                    return size, True
+                if len(page) == 0:
+                    return size, False
+
+                # either this is the entire wish history, or the list was truncated
+                next_page = self._request('getGachaLog', params | { 'end_id': page[-1]['id'] })['list']
+            except RequestRejectedError:
+                logging.info('Page size %d was rejected', size)
+                continue
+
+            if len(next_page) == 0:
+                return size, False
+            return len(page), True
+
+        # every larger size was rejected. that was only about the size if the
+        # default size is accepted; if it isn't, this raises instead
+        self._request('getGachaLog', { 'gacha_type': banner_type, 'size': self.DEFAULT_PAGE_SIZE })
+        return self.DEFAULT_PAGE_SIZE, True
+
+    def _get_page_size(self, banner_type):
+        with self._page_size_lock:
+            if self._region not in self._page_sizes:
+                stored_size = self._database.get_meta(f'page_size_{self._region}')
+                if stored_size is not None:
+                    self._page_sizes[self._region] = int(stored_size)
+                else:
+                    size, certain = self._negotiate_page_size(banner_type)
+                    logging.info('Using page size %d for region %s', size, self._region)
+                    self._page_sizes[self._region] = size
+                    if certain:
+                        self._database.store_meta(f'page_size_{self._region}', size)
+
+            return self._page_sizes[self._region]
+
+    def _lower_page_size(self, size):
+        with self._page_size_lock:
+            if size < self._page_sizes.get(self._region, self.DEFAULT_PAGE_SIZE):
+                logging.info('Lowering page size for region %s to %d', self._region, size)
+                self._page_sizes[self._region] = size
+                self._database.store_meta(f'page_size_{self._region}', size)
+
+    # a single page of the wish history of a banner type below end_id, newest wishes first
+    def _fetch_wish_history_page(self, banner_type, end_id=None, size=None):
+        if size is None:
+            size = self._get_page_size(banner_type)
+
         params = {
             'gacha_type': banner_type,
-            'size': 20
+            'size': size
         }
 
         if end_id is not None:
             params['end_id'] = end_id
 
-        latest_wish_id = None
-        while (result := self._request('getGachaLog', params)) and len(result['list']) > 0:
-            end_id = None
-            for wish in result['list']:
-                # get the latest wish and store it;
-                # this is the earliest point we can do this, because
-                # only when we start fetching wish history from
-                # mihoyo's API will we get the UID for our auth token
-                if latest_wish_id is None:
-                    latest_wish_id = self._database.get_latest_wish_id(wish['uid'], banner_type)
-                    logging.debug('Last wish id for banner type %d is %d', banner_type, latest_wish_id or 0)
-
-                # return when we reach the latest wish we already have in our history
-                logging.debug('Current wish id is %s. (%s - %s)', wish['id'], wish['time'], wish['name'])
-                if latest_wish_id is not None and latest_wish_id == int(wish['id']):
-                    logging.debug('Current id and last id match, returning')
+        try:
+            return self._request('getGachaLog', params)['list']
+        except RequestRejectedError:
+            if size <= self.DEFAULT_PAGE_SIZE:
+                raise
+
+            # only remember the smaller size once we know it's accepted
+            # where the larger one wasn't; otherwise, this raises as well
+            page = self._fetch_wish_history_page(banner_type, end_id, self.DEFAULT_PAGE_SIZE)
+            logging.warning('Page size %d was rejected, falling back to %d', size, self.DEFAULT_PAGE_SIZE)
+            self._lower_page_size(self.DEFAULT_PAGE_SIZE)
+            return page
+
+    # yields the wish history of a banner type below end_id page by
+    # page, newest wishes first. it's up to the caller to stop iterating.
+    # while the caller processes a page, the next one is already being
+    # requested, unless is_last_page(page) says the caller is going to stop
+    # after this page. when the caller stops anyway, a request that is still
+    # in flight is cancelled, or its page dropped once it arrives
+    def _fetch_wish_history_pages(self, banner_type, end_id=None, is_last_page=None):
+        executor = None
+        next_page = None
+        short_page_size = None
+        try:
+            while True:
+                if next_page is not None:
+                    size, future = next_page
+                    next_page = None
+                    page = future.result()
+                else:
+                    size = self._get_page_size(banner_type)
+                    page = self._fetch_wish_history_page(banner_type, end_id, size)
+                if len(page) == 0:
                     return
 
-                yield wish
-                end_id = wish['id']
-
-            params['end_id'] = end_id
-            sleep(0.1)  # reasonable delay..?
+                # a short page that isn't the last one means the api truncated it
+                if short_page_size is not None:
+                    self._lower_page_size(short_page_size)
+                short_page_size = len(page) if len(page) < size else None
+
+                # a short page is most likely the last one, so don't bother prefetching
+                end_id = page[-1]['id']
+                last_page = is_last_page(page) if is_last_page is not None else False
+                if short_page_size is None and not last_page:
+                    if executor is None:
+                        executor = ThreadPoolExecutor(max_workers=1)
+                    size = self._get_page_size(banner_type)
+                    next_page = (size, executor.submit(self._fetch_wish_history_page, banner_type, end_id, size))
+
+                yield page
+        finally:
+            if next_page is not None:
+                next_page[1].cancel()
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
 
     def set_region_and_auth_token(self, region, auth_token):
         self._region = region
         self._auth_token = auth_token
+        self._uid = None
+
+    # banner types hardly ever change, so they are only fetched again once
+    # they are older than BANNER_TYPES_TTL, or when we come across a wish
+    # from a banner type we don't know. they're only stored if they changed
+    def fetch_and_store_banner_types(self, force=False):
+        fetched_at = self._database.get_meta('banner_types_fetched_at')
+        if not force and fetched_at is not None and time() - float(fetched_at) < self.BANNER_TYPES_TTL:
+            logging.info('Banner types are up to date')
+            return
 
-    def fetch_and_store_banner_types(self):
         logging.info('Fetching banner types')
         result = self._request('getConfigList')
-        self._database.store_banner_types(result['gacha_type_list'])
+        banner_types_hash = hashlib.sha256(json.dumps(result['gacha_type_list'], sort_keys=True).encode('utf-8')).hexdigest()
+        if banner_types_hash != self._database.get_meta('banner_types_hash'):
+            self._database.store_banner_types(result['gacha_type_list'])
+            self._database.store_meta('banner_types_hash', banner_types_hash)
+        self._database.store_meta('banner_types_fetched_at', time())
+
+    # refresh the banner types if a page contains a wish of a banner type we don't
+    # know yet. this happens at most once per client and unknown banner type
+    def _check_gacha_types(self, page):
+        with self._banner_types_lock:
+            if self._known_gacha_types is None:
+                self._known_gacha_types = set(str(banner_type) for banner_type in self._database.get_banner_types())
+
+            unknown_gacha_types = set(wish['gacha_type'] for wish in page) - self._known_gacha_types - self._unresolved_gacha_types
+            if len(unknown_gacha_types) == 0:
+                return
+
+            logging.info('Found wishes of unknown banner types %s, refreshing banner types', ', '.join(unknown_gacha_types))
+            # not self.fetch_and_store_banner_types, which subclasses may turn into a coroutine
+            Client.fetch_and_store_banner_types(self, force=True)
+            self._known_gacha_types = set(str(banner_type) for banner_type in self._database.get_banner_types())
+            self._unresolved_gacha_types.update(unknown_gacha_types - self._known_gacha_types)
 
-    def fetch_and_store_wish_history(self):
-        logging.info('Fetching wish history')
-        new_wishes_count = 0
-        for banner_type in self._database.get_banner_types():
-            logging.info('Fetching wish history for banner type %s', banner_type)
-            wishes = []
-            for wish in self._fetch_wish_history(banner_type):
-                wishes.append({
-                    'id': int(wish['id']),  # convert to int for proper sorting
-                    'uid': int(wish['uid']),
+    @staticmethod
+    def _convert_wish(wish, banner_type):
+        return {
+            'id': int(wish['id']),
+            'uid': int(wish['uid']),
+            'banner_type': banner_type,
+            'type': ItemType.CHARACTER if wish['item_type'] == 'Character' else ItemType.WEAPON,
+            'rarity': int(wish['rank_type']),
+            'time': wish['time'],
+            'name': wish['name']
+        }
+
+    # fetch and store all wishes between end_id and target_id (both exclusive).
+    # wishes are stored while they are being fetched, one batch of pages per
+    # transaction, so memory usage does not grow with the size of the history.
+    # every batch also stores a fetch cursor, so an interrupted fetch can later
+    # be resumed where it stopped. without a uid, we fetch from the newest wish
+    # down to the latest wish we already have stored
+    def _fetch_and_store_wish_range(self, banner_type, uid=None, end_id=None, target_id=None):
+        fetched_wishes_count = 0
+        stored_wishes_count = 0
+        batch = []
+        batch_pages = 0
+        # a resumed range always has a cursor, a new one only once it stored one
+        has_fetch_cursor = end_id is not None
+
+        def store_batch(completed):
+            nonlocal fetched_wishes_count, stored_wishes_count, batch, batch_pages, end_id, has_fetch_cursor
+            if len(batch) > 0:
+                end_id = batch[-1]['id']
+            fetched_wishes_count += len(batch)
+            fetch_cursor = None
+            if not completed or has_fetch_cursor:
+                fetch_cursor = {
+                    'uid': uid,
                     'banner_type': banner_type,
-                    'type': ItemType.CHARACTER if wish['item_type'] == 'Character' else ItemType.WEAPON,
-                    'rarity': int(wish['rank_type']),
-                    'time': wish['time'],
-                    'name': wish['name']
-                })
+                    'end_id': None if completed else end_id,
+                    'target_id': target_id
+                }
+            stored_wishes_count += self._database.store_wish_history(batch, fetch_cursor)
+            has_fetch_cursor = not completed
+            batch = []
+            batch_pages = 0
+
+        # called before a page is handed to us, so the next page
+        # isn't prefetched when this page already reaches the target
+        def is_last_page(page):
+            nonlocal uid, target_id
+            # get the latest wish we have stored;
+            # this is the earliest point we can do this, because
+            # only when we start fetching wish history from
+            # mihoyo's API will we get the UID for our auth token
+            if uid is None:
+                uid = int(page[0]['uid'])
+                self._uid = uid
+                target_id = self._database.get_latest_wish_id(uid, banner_type) or 0
+                logging.debug('Last wish id for banner type %d is %d', banner_type, target_id)
+
+            return int(page[-1]['id']) <= target_id
 
-            logging.info('Got %d wishes', len(wishes))  # TODO: log how many wishes we actually _stored_ (after implementing fetching missing wishes and de-duplication)
-            new_wishes_count += len(wishes)
-            wishes.sort(key=lambda wish: wish['id'])
-            self._database.store_wish_history(wishes)
+        try:
+            for page in self._fetch_wish_history_pages(banner_type, end_id, is_last_page):
+                self._check_gacha_types(page)
+                reached_target = False
+                batch_length = len(batch)
+                for wish in page:
+                    # stop when we reach a wish we already have in our history
+                    logging.debug('Current wish id is %s. (%s - %s)', wish['id'], wish['time'], wish['name'])
+                    if int(wish['id']) <= target_id:
+                        logging.debug('Reached wish id %d, stopping', target_id)
+                        reached_target = True
+                        break
+
+                    batch.append(self._convert_wish(wish, banner_type))
+
+                self._report_progress('page', banner_type=banner_type, wishes=len(batch) - batch_length)
+                if reached_target:
+                    break
+
+                batch_pages += 1
+                if batch_pages >= self._pages_per_batch:
+                    store_batch(completed=False)
+        except Exception:
+            # keep what we already have, and remember where to resume from
+            if uid is not None and len(batch) > 0:
+                store_batch(completed=False)
+            raise
+
+        if uid is not None:
+            store_batch(completed=True)
+
+        return uid, fetched_wishes_count, stored_wishes_count
+
+    # compare the remote wish history below end_id, down to stop_id (exclusive),
+    # with the wishes we have stored. every hole we find is stored as a fetch
+    # cursor, so it gets filled just like an interrupted fetch. the wish ids
+    # the api hands out carry no counts or offsets, so holes can't be bisected;
+    # instead every page checks a whole run of neighbouring ids at once, and we
+    # skip straight to the end of a hole instead of walking through it.
+    # returns the highest and lowest wish ids of the range we verified
+    def _verify_wish_range(self, banner_type, uid, end_id=None, stop_id=0):
+        highest_id = None
+        holes = []
+        while len(page := self._fetch_wish_history_page(banner_type, end_id)) > 0:
+            remote_ids = [ int(wish['id']) for wish in page if int(wish['id']) > stop_id ]
+            if len(remote_ids) == 0:
+                break
+
+            if highest_id is None:
+                highest_id = remote_ids[0]
+
+            local_ids = self._database.get_wish_ids(uid, banner_type, remote_ids[-1], end_id)
+            last_id = end_id if end_id is not None else remote_ids[0] + 1
+            next_end_id = remote_ids[-1]
+            local_index = 0
+            remote_index = 0
+            while remote_index < len(remote_ids):
+                remote_id = remote_ids[remote_index]
+                local_id = local_ids[local_index] if local_index < len(local_ids) else None
+                if remote_id == local_id:
+                    last_id = remote_id
+                    local_index += 1
+                    remote_index += 1
+                elif local_id is not None and local_id > remote_id:
+                    # stored, but not known to the api (anymore)
+                    local_index += 1
+                else:
+                    # the hole goes down to the next wish we have stored
+                    if local_id is None:
+                        target_id = self._database.get_latest_wish_id(uid, banner_type, remote_ids[-1]) or 0
+                        next_end_id = target_id
+                    else:
+                        target_id = local_id
+
+                    logging.info('Found missing wishes for banner type %s between wish ids %d and %d', banner_type, target_id, last_id)
+                    holes.append({
+                        'uid': uid,
+                        'banner_type': banner_type,
+                        'end_id': last_id,
+                        'target_id': target_id
+                    })
+                    while remote_index < len(remote_ids) and remote_ids[remote_index] > target_id:
+                        remote_index += 1
+
+            end_id = next_end_id
+            if len(remote_ids) < len(page) or end_id <= stop_id:
+                break
+        else:
+            # we've reached the end of the wish history
+            end_id = stop_id
+
+        self._database.store_fetch_cursors(holes)
+        return highest_id, max(end_id or 0, stop_id)
+
+    # verify what we have stored against the api. ranges that were
+    # verified before are skipped, so only new wishes get checked again
+    def _verify_banner_wish_history(self, banner_type, uid):
+        logging.info('Verifying wish history for banner type %s', banner_type)
+        verified_range = self._database.get_verified_range(uid, banner_type)
+        if verified_range is None:
+            highest_id, lowest_id = self._verify_wish_range(banner_type, uid)
+        else:
+            low_id, high_id = verified_range
+            highest_id, _ = self._verify_wish_range(banner_type, uid, stop_id=high_id)
+            highest_id = highest_id or high_id
+            lowest_id = low_id
+            if low_id > 0:
+                _, lowest_id = self._verify_wish_range(banner_type, uid, end_id=low_id)
+
+        if highest_id is not None:
+            self._database.store_verified_range(uid, banner_type, lowest_id, highest_id)
+
+    def _fetch_and_store_banner_wish_history(self, banner_type, verify=False):
+        logging.info('Fetching wish history for banner type %s', banner_type)
+        uid, fetched_wishes_count, stored_wishes_count = self._fetch_and_store_wish_range(banner_type)
+
+        if uid is not None and verify:
+            self._verify_banner_wish_history(banner_type, uid)
+
+        # resume fetches that were interrupted in a previous update, and fill holes
+        if uid is not None:
+            for end_id, target_id in self._database.get_fetch_cursors(uid, banner_type):
+                logging.info('Fetching missing wishes for banner type %s below wish id %d', banner_type, end_id)
+                _, fetched, stored = self._fetch_and_store_wish_range(banner_type, uid, end_id, target_id)
+                fetched_wishes_count += fetched
+                stored_wishes_count += stored
+
+        logging.info('Got %d wishes for banner type %s, %d of them new', fetched_wishes_count, banner_type, stored_wishes_count)
+        self._report_progress('banner', banner_type=banner_type, new_wishes=stored_wishes_count)
+        return stored_wishes_count
+
+    def _log_request_stats(self):
+        logging.info('Request rate is now %.2f requests/s, throttled %d times so far', self._rate_limiter.rate, self._rate_limiter.throttle_count)
+        for endpoint, stats in self.retry_stats.items():
+            for kind, kind_stats in stats.items():
+                logging.info('Retried %s %d times after %s errors, waiting %.2fs', endpoint, kind_stats['retries'], kind, kind_stats['wait'])
+
+    # every banner type is fetched and stored on its own, so a failing
+    # banner type does not throw away what the others have already stored.
+    # with verify, the stored history is also checked for missing wishes
+    def fetch_and_store_wish_history(self, verify=False):
+        logging.info('Fetching wish history')
+        banner_types = self._database.get_banner_types()
+        with ThreadPoolExecutor(max_workers=self._max_concurrent_banners) as executor:
+            new_wishes_count = sum(executor.map(lambda banner_type: self._fetch_and_store_banner_wish_history(banner_type, verify), banner_types))
 
+        self._log_request_stats()
         return new_wishes_count
 
     def get_banner_types(self):
@@ -148,23 +557,81 @@ class Client:
 
         return (query_params['game_biz'][0], query_params['authkey'][0])
 
+    # the last wish history url in data, or None. data can be anything that
+    # can be searched like bytes, and is searched from the end, so that only
+    # the tail of a memory-mapped file is usually ever read. like the cache
+    # itself, urls end with a null byte, and never contain newlines
+    @classmethod
+    def _search_last_auth_token_url(cls, data):
+        end = len(data)
+        while (start := data.rfind(cls.AUTH_TOKEN_URL_PREFIX, 0, end)) != -1:
+            url_end = data.find(b'\0', start + len(cls.AUTH_TOKEN_URL_PREFIX))
+            if url_end > start + len(cls.AUTH_TOKEN_URL_PREFIX):
+                url = data[start:url_end]
+                if b'\n' not in url:
+                    return url.decode('utf-8')
+
+            end = start
+
+        return None
+
+    @classmethod
+    def _find_last_auth_token_url(cls, path):
+        with path.open('rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return None
+
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as cache_file:
+                return cls._search_last_auth_token_url(cache_file)
+
+    # while genshin is running, windows won't let us open its cache file, so
+    # there we search a copy of it instead. elsewhere it can be read in place,
+    # and we only fall back to making a copy if that doesn't work out
+    @classmethod
+    def _find_last_auth_token_url_in_cache_file(cls, path):
+        if cls.READ_CACHE_FILE_IN_PLACE:
+            try:
+                return cls._find_last_auth_token_url(path)
+            except OSError as err:
+                logging.warning('Could not read cache file in place (%s), copying it instead', err)
+
+        copy_path = copy_cache_file(path)
+        if copy_path is None:
+            raise LogNotFoundError('Genshin Impact is not installed or has not been started yet, or the cache file could not be copied.')
+
+        return cls._find_last_auth_token_url(copy_path)
+
+    # the result is remembered together with the size and modification time
+    # of the cache file. as long as neither changed, the file is neither
+    # copied nor searched again
     @staticmethod
     def extract_region_and_auth_token_from_file():
-        path = get_cache_path()
-        if path is None or not path.exists():
+        game_path = get_game_path()
+        path = find_cache_file(game_path) if game_path is not None else None
+        if path is None:
             raise LogNotFoundError('Genshin Impact is not installed or has not been started yet, or the cache file could not be copied.')
 
-        with path.open('rb') as fp:
-            cache_file = fp.read()
+        try:
+            stat = path.stat()
+        except OSError:
+            raise LogNotFoundError('Genshin Impact is not installed or has not been started yet, or the cache file could not be copied.')
 
-        url = None
-        regex = re.compile(b'(https://webstatic-sea.hoyoverse.com/genshin/event/.+?)\0')
-        matches = regex.findall(cache_file)
-        if len(matches) > 0:
-            url = matches[-1].decode('utf-8')
+        extracted = get_state('extracted_auth_token')
+        if extracted is not None and extracted['cache_path'] == str(path) and extracted['size'] == stat.st_size and extracted['mtime'] == stat.st_mtime_ns:
+            logging.debug('Cache file is unchanged, reusing the extracted auth token')
+            return (extracted['region'], extracted['auth_token'])
 
+        url = Client._find_last_auth_token_url_in_cache_file(path)
         if url is None:
             raise AuthTokenExtractionError('Could not find authentication token in the log file. Open the wish history in the game, then try again.')
 
         region, auth_token = Client.extract_region_and_auth_token(url)
+        set_state('extracted_auth_token', {
+            'game_path': str(game_path),
+            'cache_path': str(path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'region': region,
+            'auth_token': auth_token
+        })
         return (region, auth_token)
@@ -0,0 +1,161 @@
+import logging
+from base64 import b64encode
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from threading import Lock, Thread
+from time import monotonic, sleep
+from urllib.parse import unquote, urlsplit
+from urllib.request import getproxies, proxy_bypass
+
+
+# a minimal pool of keep-alive http.client connections, so that
+# consecutive requests to the same host can skip the tcp and tls
+# handshakes. idle connections are closed by a background thread.
+# proxies are picked up from the environment (or the system settings on
+# windows and macos) like urllib does: https is tunneled through the
+# proxy with CONNECT, plain http is sent to the proxy with the full url
+class ConnectionPool:
+    def __init__(self, idle_timeout=30, max_idle_per_host=4, timeout=30):
+        self._idle_timeout = idle_timeout
+        self._max_idle_per_host = max_idle_per_host
+        self._timeout = timeout
+        self._idle_connections = {}  # (scheme, host, port) -> [ (connection, last used), ... ]
+        self._lock = Lock()
+        self._reaper = None
+        self._proxies = getproxies()
+        self._proxy_routes = {}  # (scheme, host, port) -> (proxy host, proxy port, headers) or None
+
+    # the proxy to use for key, if any. looked up once per key, as checking
+    # whether a host bypasses the proxy can mean reading the system settings
+    def _get_proxy(self, key):
+        with self._lock:
+            if key in self._proxy_routes:
+                return self._proxy_routes[key]
+
+        scheme, host, _ = key
+        proxy = self._proxies.get(scheme)
+        if proxy is not None and not proxy_bypass(host):
+            proxy_url = urlsplit(proxy if '://' in proxy else f'http://{proxy}')
+            headers = {}
+            if proxy_url.username is not None:
+                credentials = f'{unquote(proxy_url.username)}:{unquote(proxy_url.password or "")}'
+                headers['Proxy-Authorization'] = 'Basic ' + b64encode(credentials.encode('utf-8')).decode('ascii')
+            route = (proxy_url.hostname, proxy_url.port or 80, headers)
+        else:
+            route = None
+
+        with self._lock:
+            self._proxy_routes[key] = route
+        return route
+
+    def _create_connection(self, key):
+        scheme, host, port = key
+        proxy = self._get_proxy(key)
+        if proxy is None:
+            connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+            logging.debug('Opening new connection to %s://%s:%s', scheme, host, port)
+            return connection_class(host, port, timeout=self._timeout)
+
+        proxy_host, proxy_port, proxy_headers = proxy
+        logging.debug('Opening new connection to %s://%s:%s through proxy %s:%s', scheme, host, port, proxy_host, proxy_port)
+        if scheme == 'https':
+            connection = HTTPSConnection(proxy_host, proxy_port, timeout=self._timeout)
+            connection.set_tunnel(host, port, proxy_headers)
+            return connection
+
+        return HTTPConnection(proxy_host, proxy_port, timeout=self._timeout)
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle_connections.get(key)
+            while idle:
+                connection, last_used = idle.pop()
+                if monotonic() - last_used < self._idle_timeout:
+                    return connection, True
+                connection.close()
+
+        return self._create_connection(key), False
+
+    def _release(self, key, connection):
+        with self._lock:
+            idle = self._idle_connections.setdefault(key, [])
+            if len(idle) >= self._max_idle_per_host:
+                connection.close()
+                return
+
+            idle.append((connection, monotonic()))
+            if self._reaper is None:
+                self._reaper = Thread(target=self._close_idle_connections, daemon=True)
+                self._reaper.start()
+
+    # runs in the background for as long as there are idle connections
+    def _close_idle_connections(self):
+        while True:
+            sleep(self._idle_timeout / 2)
+            with self._lock:
+                now = monotonic()
+                for key, idle in list(self._idle_connections.items()):
+                    for connection, last_used in idle:
+                        if now - last_used >= self._idle_timeout:
+                            logging.debug('Closing idle connection to %s://%s:%s', *key)
+                            connection.close()
+                    idle[:] = [ entry for entry in idle if now - entry[1] < self._idle_timeout ]
+                    if len(idle) == 0:
+                        del self._idle_connections[key]
+
+                if len(self._idle_connections) == 0:
+                    self._reaper = None
+                    return
+
+    # perform a GET request and return the status code and body of the response.
+    # raises http.client.HTTPException or OSError on connection errors
+    def get(self, url):
+        url = urlsplit(url)
+        key = (url.scheme, url.hostname, url.port or (443 if url.scheme == 'https' else 80))
+        path = url.path + ('?' + url.query if url.query else '')
+        headers = { 'Connection': 'keep-alive' }
+
+        # plain http goes to the proxy as is, asking for the full url
+        proxy = self._get_proxy(key)
+        if proxy is not None and url.scheme == 'http':
+            path = url.geturl()
+            headers |= proxy[2]
+
+        connection, reused = self._acquire(key)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+        except (HTTPException, OSError):
+            connection.close()
+            if not reused:
+                raise
+
+            # the server may have closed an idle connection
+            # without us noticing, so try again on a fresh one
+            logging.debug('Reused connection failed, retrying on a new one')
+            connection = self._create_connection(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (HTTPException, OSError):
+                connection.close()
+                raise
+
+        try:
+            body = response.read()
+        except (HTTPException, OSError):
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+
+        return response.status, body
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle_connections.values():
+                for connection, _ in idle:
+                    connection.close()
+            self._idle_connections.clear()
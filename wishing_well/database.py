@@ -1,7 +1,10 @@
+import gzip
 import logging
 import json
+import os
 from json.decoder import JSONDecodeError
-from shutil import copyfile
+from shutil import copyfileobj
+from threading import Lock, RLock, Thread
 import sqlite3
 
 
@@ -9,7 +12,7 @@ from .util import get_data_path, show_error
 from .enums import ItemType
 
 
-DATABASE_VERSION = 1
+DATABASE_VERSION = 2
 
 
 # decode item types stored in json.
@@ -28,10 +31,52 @@ def convert_reward_type(b):
 sqlite3.register_converter('ITEM_TYPE', convert_reward_type)
 
 
+# fetch cursors and verified ranges were added without a version bump, so
+# they may already exist. the indexes let every query find the wishes of a
+# uid and banner type without scanning or sorting the whole table
+def migrate_to_version_2(cursor):
+    # a fetch cursor marks wishes between end_id and target_id (both exclusive)
+    # that still need to be fetched, because a previous fetch was interrupted
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fetch_cursors (
+            uid INTEGER,
+            banner_type INTEGER,
+            end_id INTEGER,
+            target_id INTEGER,
+            PRIMARY KEY (uid, banner_type, target_id)
+        )
+    ''')
+
+    # every remote wish from low_id to high_id (both inclusive) was
+    # verified to either be stored, or to be covered by a fetch cursor
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS verified_ranges (
+            uid INTEGER,
+            banner_type INTEGER,
+            low_id INTEGER,
+            high_id INTEGER,
+            PRIMARY KEY (uid, banner_type)
+        )
+    ''')
+
+    cursor.execute('CREATE INDEX wish_history_uid_banner_type_id ON wish_history (uid, banner_type, id)')
+    cursor.execute('CREATE INDEX wish_history_uid_time ON wish_history (uid, time)')
+
+
+# the migration to every database version after the first, in order
+MIGRATIONS = {
+    2: migrate_to_version_2
+}
+
+
+# hands out a cursor on one of the database's connections, and gives the
+# connection back afterwards. changes that weren't committed are rolled
+# back, as the connection lives on and is going to be used again
 class DatabaseConnectionContextManager:
-    def __init__(self, database_path):
-        self._database_path = database_path
-        self._connection = sqlite3.connect(self._database_path, detect_types=sqlite3.PARSE_DECLTYPES)
+    def __init__(self, connection, release):
+        self._connection = connection
+        self._release = release
+        self._total_changes = connection.total_changes
         self.cursor = self._connection.cursor()
 
     def __enter__(self):
@@ -39,18 +84,50 @@ class DatabaseConnectionContextManager:
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
         self.cursor.close()
-        self._connection.close()
+        if self._connection.in_transaction:
+            self._connection.rollback()
+        self._release(self._connection)
 
         # to not ignore any exceptions that happened inside a with block
         return False
 
-    def commit(self):
+    # every commit that changed any rows also bumps the change counter in the
+    # meta table, so backups can tell whether there is anything new to back up
+    def commit(self, count_change=True):
+        if count_change and self._connection.in_transaction and self._connection.total_changes != self._total_changes:
+            self.cursor.execute('''
+                INSERT INTO meta (name, data) VALUES ("changes", 1)
+                ON CONFLICT (name) DO UPDATE SET data = data + 1
+            ''')
         self._connection.commit()
+        self._total_changes = self._connection.total_changes
 
+# connections are kept open for as long as the database is used, so their
+# statement caches stay warm. all writes go through a single connection,
+# one at a time. reads use a small pool of connections, each of which is
+# used by only one thread at a time, so any thread may read concurrently
 class Database:
+    MAX_IDLE_READERS = 4
+    # with wal, readers don't have to wait for updates that are being written,
+    # and synchronous=NORMAL then only syncs on checkpoints, not on every commit
+    JOURNAL_MODE = 'WAL'
+    # applied to every connection
+    PRAGMAS = {
+        'synchronous': 'NORMAL',
+        'cache_size': -8192,  # in kibibytes
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY'
+    }
+    BACKUP_GENERATIONS = 3
+    BACKUP_COMPRESS = False
+
     def __init__(self):
         data_path = get_data_path()
         self._database_path = data_path / 'database.sqlite3'
+        self._writer = None
+        self._write_lock = RLock()
+        self._idle_readers = []
+        self._readers_lock = Lock()
 
         # create the database if it does not exist yet
         if not self._database_path.exists():
@@ -66,21 +143,152 @@ class Database:
             except (IndexError, sqlite3.DatabaseError, sqlite3.OperationalError):
                 show_error('Could not find version information in the database. The database might be corrupt.')
 
-        # exit if the version does not match. in the future, migrate if version is lower
-        if version != DATABASE_VERSION:
+        # exit if the version is newer than what we know about
+        if version > DATABASE_VERSION:
             show_error('Unknown database version. Shutting down to not mess with any data.')
 
-        # create a backup
-        logging.info('Creating database backup')
-        copyfile(self._database_path, data_path / 'database.sqlite3.bak')
+        with self._get_database_connection(write=True) as db:
+            journal_mode = db.cursor.execute(f'PRAGMA journal_mode = {self.JOURNAL_MODE}').fetchone()[0]
+        if journal_mode.upper() != self.JOURNAL_MODE.upper():
+            logging.warning('Could not switch the database to journal mode %s, using %s', self.JOURNAL_MODE, journal_mode)
+
+        # back up the database before migrating it. otherwise, there's no need
+        # to wait for the backup, so it's made in the background
+        if version < DATABASE_VERSION:
+            self.back_up()
+            self._migrate(version)
+        else:
+            Thread(target=self.back_up, daemon=True).start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self._database_path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        for name, value in self.PRAGMAS.items():
+            connection.execute(f'PRAGMA {name} = {value}')
+
+        return connection
+
+    # with write, the connection is the writer connection, which no other thread
+    # can use until the with block is left. commit() is only allowed with write
+    def _get_database_connection(self, write=False):
+        if write:
+            self._write_lock.acquire()
+            try:
+                if self._writer is None:
+                    self._writer = self._connect()
+            except Exception:
+                self._write_lock.release()
+                raise
+
+            return DatabaseConnectionContextManager(self._writer, self._release_writer)
+
+        with self._readers_lock:
+            reader = self._idle_readers.pop() if len(self._idle_readers) > 0 else None
+        if reader is None:
+            reader = self._connect()
+
+        return DatabaseConnectionContextManager(reader, self._release_reader)
+
+    def _release_writer(self, connection):
+        self._write_lock.release()
+
+    def _release_reader(self, connection):
+        with self._readers_lock:
+            if len(self._idle_readers) < self.MAX_IDLE_READERS:
+                self._idle_readers.append(connection)
+                return
+
+        connection.close()
+
+    def _get_backup_path(self, generation):
+        suffix = f'.bak.{generation}' if generation > 0 else '.bak'
+        if self.BACKUP_COMPRESS:
+            suffix += '.gz'
+        return self._database_path.with_name(self._database_path.name + suffix)
+
+    # back up the database with sqlite's online backup api, which is safe while
+    # the database is in use. the newest backup is database.sqlite3.bak, older
+    # ones get numbered, up to BACKUP_GENERATIONS. when nothing has changed
+    # since the last backup, no new one is made
+    def back_up(self):
+        try:
+            source = self._connect()
+            try:
+                row = source.execute('SELECT data FROM meta WHERE name = "changes"').fetchone()
+                changes = row[0] if row is not None else 0
+                row = source.execute('SELECT data FROM meta WHERE name = "backup_changes"').fetchone()
+                if row is not None and row[0] == changes and self._get_backup_path(0).exists():
+                    logging.info('Database has not changed since the last backup')
+                    return
+
+                logging.info('Creating database backup')
+                temp_path = self._database_path.with_name(self._database_path.name + '.bak.tmp')
+                destination = sqlite3.connect(temp_path)
+                try:
+                    source.backup(destination, pages=1024)
+                finally:
+                    destination.close()
+            finally:
+                source.close()
+
+            if self.BACKUP_COMPRESS:
+                compressed_path = temp_path.with_name(temp_path.name + '.gz')
+                with temp_path.open('rb') as input_fp, gzip.open(compressed_path, 'wb') as output_fp:
+                    copyfileobj(input_fp, output_fp)
+                temp_path.unlink()
+                temp_path = compressed_path
+
+            # rotate the older backups, dropping the oldest one
+            self._get_backup_path(self.BACKUP_GENERATIONS - 1).unlink(missing_ok=True)
+            for generation in range(self.BACKUP_GENERATIONS - 2, -1, -1):
+                if self._get_backup_path(generation).exists():
+                    os.replace(self._get_backup_path(generation), self._get_backup_path(generation + 1))
+            os.replace(temp_path, self._get_backup_path(0))
+
+            with self._get_database_connection(write=True) as db:
+                db.cursor.execute('INSERT OR REPLACE INTO meta (name, data) VALUES ("backup_changes", ?)', (changes,))
+                db.commit(count_change=False)
+        except (OSError, sqlite3.Error) as err:
+            logging.error('Could not back up the database: %s', err)
+
+    # move everything from the write-ahead log into the database file
+    def checkpoint(self):
+        if self.JOURNAL_MODE.upper() != 'WAL':
+            return
 
-    def _get_database_connection(self):
-        return DatabaseConnectionContextManager(self._database_path)
+        with self._get_database_connection(write=True) as db:
+            db.cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self.checkpoint()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+        with self._readers_lock:
+            for reader in self._idle_readers:
+                reader.close()
+            self._idle_readers = []
+
+    # every migration runs in its own transaction, together with the version bump.
+    # if one fails, the database stays at the version of the last one that didn't
+    def _migrate(self, version):
+        for next_version in range(version + 1, DATABASE_VERSION + 1):
+            logging.info('Migrating database to version %d', next_version)
+            with self._get_database_connection(write=True) as db:
+                try:
+                    db.cursor.execute('BEGIN')
+                    MIGRATIONS[next_version](db.cursor)
+                    db.cursor.execute('UPDATE meta SET data = ? WHERE name = "version"', (next_version,))
+                    db.commit()
+                except sqlite3.Error as err:
+                    logging.exception(err)
+                    show_error(f'Could not migrate the database to version {next_version}.')
 
     def _create_database(self):
         logging.info('No existing database found, creating new one')
 
-        with self._get_database_connection() as db:
+        with self._get_database_connection(write=True) as db:
             # create tables
             db.cursor.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, data BLOB)')
             db.cursor.execute('CREATE TABLE banner_types (id INTEGER PRIMARY KEY, name TEXT)')
@@ -97,8 +305,9 @@ class Database:
                 )
             ''')
 
-            # insert version
-            db.cursor.execute('INSERT INTO meta VALUES ("version", ?)', (DATABASE_VERSION,))
+            # insert version. this is the schema of the first version,
+            # the migrations take it to the current one right after
+            db.cursor.execute('INSERT INTO meta VALUES ("version", ?)', (1,))
             db.commit()
 
             # check if there's an old .json database we can convert
@@ -137,6 +346,17 @@ class Database:
                 logging.info('Finished conversion, deleting old database.json')
                 json_database_path.unlink()
 
+    def get_meta(self, name):
+        with self._get_database_connection() as db:
+            row = db.cursor.execute('SELECT data FROM meta WHERE name = ?', (name,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def store_meta(self, name, data):
+        with self._get_database_connection(write=True) as db:
+            db.cursor.execute('INSERT OR REPLACE INTO meta (name, data) VALUES (?, ?)', (name, data))
+            db.commit()
+
     def get_banner_types(self):
         banner_types = {}
         with self._get_database_connection() as db:
@@ -149,7 +369,7 @@ class Database:
 
     def store_banner_types(self, banner_types):
         logging.info('Storing banner types')
-        with self._get_database_connection() as db:
+        with self._get_database_connection(write=True) as db:
             db.cursor.executemany('''
                 INSERT OR IGNORE INTO banner_types (id, name) VALUES (:key, :name)
             ''', banner_types)
@@ -185,25 +405,89 @@ class Database:
                 'name': wish[5]
             }
 
-    def get_latest_wish_id(self, uid, banner_type):
+    # the latest wish id overall, or the latest one below end_id
+    def get_latest_wish_id(self, uid, banner_type, end_id=None):
         with self._get_database_connection() as db:
             try:
-                id_ = db.cursor.execute('SELECT MAX(id) FROM wish_history WHERE uid = ? AND banner_type = ?', (uid, banner_type)).fetchone()[0]
+                if end_id is None:
+                    id_ = db.cursor.execute('SELECT MAX(id) FROM wish_history WHERE uid = ? AND banner_type = ?', (uid, banner_type)).fetchone()[0]
+                else:
+                    id_ = db.cursor.execute('SELECT MAX(id) FROM wish_history WHERE uid = ? AND banner_type = ? AND id < ?', (uid, banner_type, end_id)).fetchone()[0]
             except IndexError:
                 id_ = None
 
         return id_
 
-    def store_wish_history(self, wishes):
-        if len(wishes) == 0:
-            return
+    # wish ids from start_id (inclusive) up to end_id (exclusive), newest first
+    def get_wish_ids(self, uid, banner_type, start_id, end_id=None):
+        with self._get_database_connection() as db:
+            ids = db.cursor.execute('''
+                SELECT id FROM wish_history
+                WHERE uid = ? AND banner_type = ? AND id >= ? AND id < ?
+                ORDER BY id DESC
+            ''', (uid, banner_type, start_id, end_id if end_id is not None else 2 ** 63 - 1)).fetchall()
 
-        logging.info('Storing wish history')
+        return [ id_[0] for id_ in ids ]
+
+    def get_verified_range(self, uid, banner_type):
+        with self._get_database_connection() as db:
+            return db.cursor.execute('''
+                SELECT low_id, high_id FROM verified_ranges WHERE uid = ? AND banner_type = ?
+            ''', (uid, banner_type)).fetchone()
+
+    def store_verified_range(self, uid, banner_type, low_id, high_id):
+        with self._get_database_connection(write=True) as db:
+            db.cursor.execute('''
+                INSERT OR REPLACE INTO verified_ranges ( uid, banner_type, low_id, high_id ) VALUES ( ?, ?, ?, ? )
+            ''', (uid, banner_type, low_id, high_id))
+            db.commit()
+
+    def store_fetch_cursors(self, fetch_cursors):
+        with self._get_database_connection(write=True) as db:
+            db.cursor.executemany('''
+                INSERT OR REPLACE INTO fetch_cursors
+                ( uid, banner_type, end_id, target_id )
+                VALUES
+                ( :uid, :banner_type, :end_id, :target_id )
+            ''', fetch_cursors)
+            db.commit()
+
+    def get_fetch_cursors(self, uid, banner_type):
         with self._get_database_connection() as db:
+            return db.cursor.execute('''
+                SELECT end_id, target_id FROM fetch_cursors
+                WHERE uid = ? AND banner_type = ? ORDER BY end_id DESC
+            ''', (uid, banner_type)).fetchall()
+
+    # returns the number of wishes that were actually stored, i.e. that were
+    # not already in the database. the fetch cursor, if given, is updated in
+    # the same transaction. a cursor without end_id is done and gets removed
+    def store_wish_history(self, wishes, fetch_cursor=None):
+        if len(wishes) == 0 and fetch_cursor is None:
+            return 0
+
+        logging.info('Storing wish history')
+        with self._get_database_connection(write=True) as db:
             db.cursor.executemany('''
                 INSERT OR IGNORE INTO wish_history
                 ( id, uid, banner_type, type, rarity, time, name )
                 VALUES
                 ( :id, :uid, :banner_type, :type, :rarity, :time, :name )
             ''', wishes)
+            stored_wishes_count = max(db.cursor.rowcount, 0)
+
+            if fetch_cursor is not None and fetch_cursor['end_id'] is None:
+                db.cursor.execute('''
+                    DELETE FROM fetch_cursors
+                    WHERE uid = :uid AND banner_type = :banner_type AND target_id = :target_id
+                ''', fetch_cursor)
+            elif fetch_cursor is not None:
+                db.cursor.execute('''
+                    INSERT OR REPLACE INTO fetch_cursors
+                    ( uid, banner_type, end_id, target_id )
+                    VALUES
+                    ( :uid, :banner_type, :end_id, :target_id )
+                ''', fetch_cursor)
             db.commit()
+
+        return stored_wishes_count
@@ -12,3 +12,9 @@ class MissingAuthTokenError(Exception):
 
 class LogNotFoundError(Exception):
     pass
+
+class AuthTokenExpiredError(EndpointError):
+    pass
+
+class RequestRejectedError(EndpointError):
+    pass
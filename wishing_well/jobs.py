@@ -0,0 +1,170 @@
+import json
+import logging
+from threading import Condition, Lock, Thread
+from time import monotonic
+from uuid import uuid4
+
+
+# a wish history update running on a worker thread. the client reports
+# its progress to the job, which keeps a summary of it that can be
+# streamed to the frontend as server-sent events
+class UpdateJob:
+    def __init__(self):
+        self.id = uuid4().hex
+        self._condition = Condition()
+        self._version = 0
+        self._banners = {}
+        self._requests = 0
+        self._total_latency = 0
+        self._last_latency = None
+        self._status = None
+        self._message = None
+        self._result = None
+        self._finished_at = None
+
+    @property
+    def finished(self):
+        return self._status is not None
+
+    @property
+    def finished_at(self):
+        return self._finished_at
+
+    @property
+    def succeeded(self):
+        return self._status is not None and self._status < 400
+
+    @property
+    def message(self):
+        return self._message
+
+    # what the update did: { 'uid': ..., 'new_wishes': ..., 'duration': seconds }
+    @property
+    def result(self):
+        return self._result
+
+    def progress(self, event, **data):
+        with self._condition:
+            if event == 'request':
+                self._requests += 1
+                self._total_latency += data['latency']
+                self._last_latency = data['latency']
+            elif event == 'page':
+                banner = self._banners.setdefault(data['banner_type'], { 'pages': 0, 'wishes': 0, 'done': False })
+                banner['pages'] += 1
+                banner['wishes'] += data['wishes']
+            elif event == 'banner':
+                banner = self._banners.setdefault(data['banner_type'], { 'pages': 0, 'wishes': 0, 'done': False })
+                banner['done'] = True
+
+            self._version += 1
+            self._condition.notify_all()
+
+    def finish(self, status, message, result=None):
+        with self._condition:
+            self._status = status
+            self._message = message
+            self._result = result
+            self._finished_at = monotonic()
+            self._version += 1
+            self._condition.notify_all()
+
+    # block until the job is finished, or the timeout passed. returns whether it finished
+    def wait(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self.finished, timeout)
+
+    def _snapshot(self):
+        return {
+            'banners': { str(banner_type): banner.copy() for banner_type, banner in self._banners.items() },
+            'requests': self._requests,
+            'lastLatency': self._last_latency,
+            'averageLatency': self._total_latency / self._requests if self._requests > 0 else None,
+            'finished': self.finished,
+            'status': self._status,
+            'message': self._message
+        }
+
+    # yields server-sent events with the current progress whenever it
+    # changes, and a comment every now and then to keep the stream alive
+    def events(self, keep_alive=15):
+        version = -1
+        while True:
+            with self._condition:
+                if self._version == version:
+                    self._condition.wait(keep_alive)
+                if self._version == version:
+                    yield ': keep-alive\n\n'
+                    continue
+
+                version = self._version
+                snapshot = self._snapshot()
+
+            yield f'event: {"done" if snapshot["finished"] else "progress"}\ndata: {json.dumps(snapshot)}\n\n'
+            if snapshot['finished']:
+                return
+
+
+# runs update jobs, coalescing concurrent updates of the same key into a
+# single job: whoever asks while a job is running joins that job and gets
+# its result. a job that succeeded less than cooldown seconds ago is
+# handed out again as well, instead of starting a new update right away
+class JobManager:
+    _retention = 300  # seconds to keep finished jobs around
+
+    def __init__(self, cooldown=30):
+        self._cooldown = cooldown
+        self._jobs = {}
+        self._jobs_by_key = {}
+        self._lock = Lock()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _remove_old_jobs(self, now):
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - job.finished_at > max(self._retention, self._cooldown):
+                del self._jobs[job_id]
+        for key, job in list(self._jobs_by_key.items()):
+            if job.id not in self._jobs:
+                del self._jobs_by_key[key]
+
+    # the job for key: a running job or one that has just succeeded, or a new one.
+    # returns the job, and whether it is new. whoever gets a new job has to run
+    # and finish it, or jobs with the same key will wait for it forever
+    def claim(self, key):
+        with self._lock:
+            now = monotonic()
+            self._remove_old_jobs(now)
+
+            job = self._jobs_by_key.get(key)
+            if job is not None and not job.finished:
+                logging.info('Joining running update job %s', job.id)
+                return job, False
+            if job is not None and job.succeeded and now - job.finished_at < self._cooldown:
+                logging.info('Update job %s finished %.1fs ago, reusing its result', job.id, now - job.finished_at)
+                return job, False
+
+            job = UpdateJob()
+            self._jobs[job.id] = job
+            self._jobs_by_key[key] = job
+            return job, True
+
+    # run target(job, *args) on a new thread, unless a job with the same key is running
+    # or has just succeeded. target is expected to finish the job itself; if it raises
+    # instead, the job is finished with an error. returns the job, and whether it is new
+    def start(self, key, target, *args):
+        job, is_new = self.claim(key)
+        if not is_new:
+            return job, False
+
+        def run():
+            try:
+                target(job, *args)
+            except Exception:
+                logging.exception('Update job %s failed', job.id)
+                job.finish(500, 'An unknown error has occurred.')
+
+        Thread(target=run, daemon=True).start()
+        return job, True
@@ -0,0 +1,68 @@
+import logging
+import random
+from threading import Lock
+from time import monotonic, sleep
+
+
+# an adaptive token bucket. the rate slowly increases while requests
+# succeed, and is halved whenever we get throttled or a request fails.
+# repeated throttling additionally pauses all requests, with an
+# exponentially growing and jittered delay
+class RateLimiter:
+    def __init__(self, rate=10, min_rate=1, max_rate=20, burst=1, rate_increase=0.5, base_backoff=1, max_backoff=60):
+        self._rate = rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._burst = burst
+        self._rate_increase = rate_increase
+        self._base_backoff = base_backoff
+        self._max_backoff = max_backoff
+
+        self._tokens = burst
+        self._last_refill = monotonic()
+        self._blocked_until = 0
+        self._consecutive_throttles = 0
+        self._throttle_count = 0
+        self._lock = Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def throttle_count(self):
+        return self._throttle_count
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    # block until we're allowed to make the next request
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                delay = max(self._blocked_until - now, (1 - self._tokens) / self._rate)
+
+            sleep(delay)
+
+    def success(self):
+        with self._lock:
+            self._consecutive_throttles = 0
+            self._rate = min(self._max_rate, self._rate + self._rate_increase / self._rate)
+
+    def throttle(self):
+        with self._lock:
+            self._throttle_count += 1
+            self._consecutive_throttles += 1
+            self._rate = max(self._min_rate, self._rate / 2)
+
+            backoff = min(self._max_backoff, self._base_backoff * 2 ** (self._consecutive_throttles - 1))
+            backoff *= random.uniform(0.5, 1)
+            self._blocked_until = max(self._blocked_until, monotonic() + backoff)
+            logging.warning('Throttled, lowering rate to %.2f requests/s and backing off for %.2fs', self._rate, backoff)
@@ -0,0 +1,45 @@
+import logging
+import random
+from threading import Lock
+from time import monotonic, sleep
+
+
+# decides whether a failed request is tried again, and waits before it is:
+# exponentially growing, jittered delays, for as long as the time budget of
+# the request lasts. how often requests were retried and how long we waited
+# is counted per kind of error, e.g. 'network', 'server' or 'throttle'
+class RetryPolicy:
+    def __init__(self, time_budget=60, base_delay=1, max_delay=30, max_retries=None):
+        self._time_budget = time_budget
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._max_retries = max_retries
+        self._stats = {}
+        self._lock = Lock()
+
+    # kind -> { 'retries': ..., 'wait': seconds }
+    @property
+    def stats(self):
+        with self._lock:
+            return { kind: stats.copy() for kind, stats in self._stats.items() }
+
+    # wait before retrying a request that started at started_at, and has
+    # been retried retries times so far. returns False instead of waiting
+    # when we're out of retries, or the wait would exceed the time budget
+    def backoff(self, kind, retries, started_at):
+        if self._max_retries is not None and retries >= self._max_retries:
+            return False
+
+        delay = min(self._max_delay, self._base_delay * 2 ** retries) * random.uniform(0.5, 1)
+        if monotonic() + delay - started_at > self._time_budget:
+            logging.warning('Giving up after %d retries, the time budget of %ds is used up', retries, self._time_budget)
+            return False
+
+        logging.warning('Request failed (%s), retrying in %.2fs', kind, delay)
+        sleep(delay)
+        with self._lock:
+            stats = self._stats.setdefault(kind, { 'retries': 0, 'wait': 0 })
+            stats['retries'] += 1
+            stats['wait'] += delay
+
+        return True
@@ -1,24 +1,41 @@
+import asyncio
 import logging
 import signal
 import sys
 import webbrowser
 from copy import deepcopy
 from pathlib import Path
+from socketserver import ThreadingMixIn
 from threading import Timer
-from time import time
+from time import monotonic, time
+from wsgiref.simple_server import WSGIServer
 
+from .async_client import update_accounts
 from .client import Client
 from .enums import ItemType
 from .exceptions import AuthTokenExtractionError, MissingAuthTokenError, EndpointError, RequestError, LogNotFoundError
+from .jobs import JobManager
+from .watcher import CacheWatcher
+
+
+# handle every request on its own thread, so long-lived event
+# streams don't keep the server from answering other requests
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
 
 
 class Server:
     _heartbeat_timeout = 90  # seconds to shutdown after receiving no heartbeat
+    _update_cooldown = 30  # seconds to answer repeated updates with the last result
     _static_headers = { 'Cache-Control': 'no-store' }
 
-    def __init__(self, bottle, port):
+    # with watch, the game's cache file is watched for new wish history
+    # urls, and the wish history is updated as soon as one shows up
+    def __init__(self, bottle, port, watch=False):
         self._bottle = bottle
         self._client = Client()
+        self._jobs = JobManager(cooldown=self._update_cooldown)
+        self._watcher = CacheWatcher(self._update_wish_history_from_watcher) if watch else None
         self._app = self._bottle.Bottle()
 
         self._app.route('/', callback=self._index)
@@ -27,9 +44,11 @@ class Server:
         self._app.route('/wishing-well', callback=self._identify)
         self._app.route('/data', callback=self._get_data)
         self._app.route('/update-wish-history', method='POST', callback=self._update_wish_history)
+        self._app.route('/update-wish-history/batch', method='POST', callback=self._update_wish_history_batch)
+        self._app.route('/update-wish-history/<job_id>', callback=self._update_wish_history_events)
         self._app.route('/heartbeat', method='POST', callback=self._heartbeat)
 
-        self._server = self._bottle.WSGIRefServer(host='localhost', port=port)
+        self._server = self._bottle.WSGIRefServer(host='localhost', port=port, server_class=ThreadingWSGIServer)
         self._last_heartbeat = time()
         self._shutdown_timer = Timer(self._heartbeat_timeout, self._shutdown)
         self._shutdown_timer.start()
@@ -37,9 +56,18 @@ class Server:
         # try to handle sigint
         signal.signal(signal.SIGINT, self._handle_sigint)
 
+        if self._watcher is not None:
+            self._watcher.start()
+
         webbrowser.open(f'http://localhost:{port}')
         self._bottle.run(self._app, server=self._server)
 
+        if self._watcher is not None:
+            self._watcher.stop()
+
+        # checkpoint the write-ahead log, so the database file is complete on its own
+        self._client.database.close()
+
     def _shutdown(self):
         logging.debug('No longer receiving heartbeats. Shutting down.')
         self._server.srv.shutdown()
@@ -197,6 +225,25 @@ class Server:
             'uids': uids
         }
 
+    # runs on a worker thread. every update gets its own client,
+    # so concurrent updates don't share auth tokens
+    def _run_update(self, job, region, auth_token, verify):
+        client = Client(database=self._client.database, progress_callback=job.progress)
+        client.set_region_and_auth_token(region, auth_token)
+        start = monotonic()
+        try:
+            client.fetch_and_store_banner_types()
+            new_wishes_count = client.fetch_and_store_wish_history(verify=verify)
+        except (MissingAuthTokenError, RequestError, EndpointError) as e:
+            job.finish(500, str(e), { 'uid': client.uid, 'new_wishes': 0, 'duration': monotonic() - start })
+            return
+
+        job.finish(200, f'Retrieved {new_wishes_count} new {"wish" if new_wishes_count == 1 else "wishes"}.',
+            { 'uid': client.uid, 'new_wishes': new_wishes_count, 'duration': monotonic() - start })
+
+    # start an update in the background. its progress can be followed via
+    # the event stream of the returned job. concurrent updates with the same
+    # auth token join the job that is already running
     def _update_wish_history(self):
         body = self._bottle.request.json
 
@@ -211,16 +258,88 @@ class Server:
                 'message': str(e)
             }
 
-        self._client.set_region_and_auth_token(region, auth_token)
-        try:
-            self._client.fetch_and_store_banner_types()
-            new_wishes_count = self._client.fetch_and_store_wish_history()
-        except (MissingAuthTokenError, RequestError, EndpointError) as e:
-            self._bottle.response.status = 500
+        verify = body.get('verify', False)
+        job, is_new = self._jobs.start(( region, auth_token, verify ), self._run_update, region, auth_token, verify)
+        self._bottle.response.status = 202
+        return {
+            'job': job.id,
+            'joined': not is_new
+        }
+
+    # runs on the watcher's thread
+    def _update_wish_history_from_watcher(self, region, auth_token):
+        job, is_new = self._jobs.start(( region, auth_token, False ), self._run_update, region, auth_token, False)
+        if is_new:
+            logging.info('Started update job %s for the new auth token', job.id)
+
+    def _update_wish_history_events(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            self._bottle.response.status = 404
             return {
-                'message': str(e)
+                'message': 'Unknown update job.'
             }
 
+        self._bottle.response.content_type = 'text/event-stream'
+        self._bottle.response.set_header('Cache-Control', 'no-store')
+        return job.events()
+
+    # update the wish histories of several accounts at once, one wish history url
+    # per account. every account keeps its own auth token, and gets its own result
+    def _update_wish_history_batch(self):
+        body = self._bottle.request.json
+        if body is None or not isinstance(body.get('urls'), list) or len(body['urls']) == 0:
+            self._bottle.response.status = 400
+            return {
+                'message': 'Expected a list of wish history URLs.'
+            }
+
+        tokens = []
+        for url in body['urls']:
+            try:
+                tokens.append(Client.extract_region_and_auth_token(url))
+            except AuthTokenExtractionError as e:
+                self._bottle.response.status = 400
+                return {
+                    'message': f'{url}: {e}'
+                }
+
+        # accounts that are already being updated, or just were, join that
+        # update job instead. the others get a job that this batch runs
+        verify = body.get('verify', False)
+        jobs = [ self._jobs.claim(( region, auth_token, verify )) for region, auth_token in tokens ]
+        new_jobs = [ ( job, token ) for ( job, is_new ), token in zip(jobs, tokens) if is_new ]
+        try:
+            results = asyncio.run(update_accounts(self._client.database, [ token for _, token in new_jobs ], verify=verify,
+                progress_callbacks=[ job.progress for job, _ in new_jobs ]))
+        except Exception:
+            for job, _ in new_jobs:
+                job.finish(500, 'An unknown error has occurred.')
+            raise
+
+        for ( job, _ ), result in zip(new_jobs, results):
+            new_wishes_count = result['new_wishes']
+            job_result = { 'uid': result['uid'], 'new_wishes': new_wishes_count, 'duration': result['duration'] }
+            if result['error'] is not None:
+                job.finish(500, str(result['error']), job_result)
+            else:
+                job.finish(200, f'Retrieved {new_wishes_count} new {"wish" if new_wishes_count == 1 else "wishes"}.', job_result)
+
+        # the same url given twice is a single job, and only counted once
+        unique_jobs = list({ job.id: job for job, _ in jobs }.values())
+        for job in unique_jobs:
+            job.wait()
+
+        new_wishes_count = sum(job.result['new_wishes'] for job in unique_jobs if job.result is not None)
+        failed_count = sum(1 for job in unique_jobs if not job.succeeded)
         return {
-            'message': f'Retrieved {new_wishes_count} new {"wish" if new_wishes_count == 1 else "wishes"}.'
+            'message': f'Retrieved {new_wishes_count} new {"wish" if new_wishes_count == 1 else "wishes"} for {len(unique_jobs)} accounts.'
+                + (f' {failed_count} of them failed.' if failed_count > 0 else ''),
+            'results': [ {
+                'uid': job.result['uid'] if job.result is not None else None,
+                'newWishes': job.result['new_wishes'] if job.result is not None else 0,
+                'duration': round(job.result['duration'], 3) if job.result is not None else None,
+                'message': job.message if not job.succeeded else None,
+                'joined': not is_new
+            } for job, is_new in jobs ]
         }
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import re
@@ -8,6 +9,7 @@ import sys
 import tkinter
 import webbrowser
 from pathlib import Path
+from threading import Lock
 from tkinter import ttk
 from urllib.request import urlopen
 from urllib.error import URLError, HTTPError
@@ -17,6 +19,7 @@ try:
 except ModuleNotFoundError:
     winreg = None
 
+_state_lock = Lock()
 
 def get_data_path():
     if sys.platform == 'win32':
@@ -44,43 +47,146 @@ def get_data_path():
 
     return path
 
-def get_cache_path():
-    game_path = None
+# small bits of state that are expensive to discover, kept in a json
+# file in the data directory, so they are remembered across restarts
+def _read_state():
     try:
-        game_path = Path(os.environ['GAME_PATH'])
-    except KeyError:
-        try:
-            log_path = Path(os.environ['USERPROFILE']) / 'AppData/LocalLow/miHoYo/Genshin Impact/output_log.txt'
-        except KeyError:
-            logging.debug('USERPROFILE environment variable does not exist')
-            return None
-
-        if not log_path.exists():
-            logging.debug('output_log.txt not found')
-            return None
-
-        regex = re.compile('Warmup file (.+)/GenshinImpact_Data')
-        with log_path.open('r') as fp:
-            for line in fp:
+        with (get_data_path() / 'state.json').open('r') as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def get_state(name):
+    with _state_lock:
+        return _read_state().get(name)
+
+def set_state(name, value):
+    with _state_lock:
+        state = _read_state()
+        state[name] = value
+        state_path = get_data_path() / 'state.json'
+        temp_path = state_path.with_suffix('.tmp')
+        with temp_path.open('w') as fp:
+            json.dump(state, fp)
+        os.replace(temp_path, state_path)
+
+# the game path of the latest start of the game. the log is read
+# backwards block by block, as the last mention is the one we want
+def _find_game_path_in_log(log_path, block_size=64 * 1024):
+    regex = re.compile(b'Warmup file (.+)/GenshinImpact_Data')
+    with log_path.open('rb') as fp:
+        end = fp.seek(0, os.SEEK_END)
+        partial_line = b''
+        while end > 0:
+            start = max(0, end - block_size)
+            fp.seek(start)
+            lines = (fp.read(end - start) + partial_line).split(b'\n')
+
+            # the first line may continue in the block before this one
+            partial_line = lines.pop(0) if start > 0 else b''
+            for line in reversed(lines):
                 match = regex.search(line)
                 if match is not None:
-                    game_path = match.group(1)
-                    break
+                    return match.group(1).decode('utf-8', errors='replace')
+
+            end = start
+
+    return None
+
+# the game path found in the log is remembered for as long as the log is unchanged
+def get_game_path():
+    try:
+        return Path(os.environ['GAME_PATH'])
+    except KeyError:
+        pass
+
+    try:
+        log_path = Path(os.environ['USERPROFILE']) / 'AppData/LocalLow/miHoYo/Genshin Impact/output_log.txt'
+    except KeyError:
+        logging.debug('USERPROFILE environment variable does not exist')
+        return None
+
+    try:
+        stat = log_path.stat()
+    except OSError:
+        logging.debug('output_log.txt not found')
+        return None
+
+    found = get_state('game_path')
+    if found is not None and found['log_path'] == str(log_path) and found['size'] == stat.st_size and found['mtime'] == stat.st_mtime_ns:
+        return Path(found['game_path'])
 
+    game_path = _find_game_path_in_log(log_path)
     if game_path is None:
         logging.debug('game path not found in output_log')
         return None
 
+    set_state('game_path', {
+        'log_path': str(log_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'game_path': game_path
+    })
+    return Path(game_path)
+
+def _parse_version(name):
+    try:
+        return tuple(int(part) for part in name.split('.'))
+    except ValueError:
+        return None
+
+# the web cache file of the game, which contains the wish history url. every
+# game version may bring its own cache directory, so we pick the one with the
+# highest version, and then the most recently modified one. the choice is
+# remembered until the cache file disappears or the cache directories change
+def find_cache_file(game_path):
+    web_caches_path = game_path / 'GenshinImpact_Data/webCaches'
+    try:
+        web_caches_mtime = web_caches_path.stat().st_mtime_ns
+    except OSError:
+        logging.debug('webCaches directory does not exist')
+        return None
+
+    found = get_state('cache_file')
+    if found is not None and found['web_caches_path'] == str(web_caches_path) and found['web_caches_mtime'] == web_caches_mtime \
+            and Path(found['cache_path']).exists():
+        return Path(found['cache_path'])
+
+    candidates = []
+    for directory in web_caches_path.iterdir():
+        # older versions of the game kept the cache directly in webCaches
+        if directory.name == 'Cache':
+            version = ()
+            path = directory / 'Cache_Data/data_2'
+        else:
+            version = _parse_version(directory.name)
+            path = directory / 'Cache/Cache_Data/data_2'
+
+        if version is None:
+            continue
+        try:
+            candidates.append(( version, path.stat().st_mtime_ns, path ))
+        except OSError:
+            continue
+
+    if len(candidates) == 0:
+        logging.debug('cache file does not exist')
+        return None
+
+    path = max(candidates, key=lambda candidate: candidate[:2])[2]
+    logging.debug('cache path is: ' + str(path))
+    set_state('cache_file', {
+        'web_caches_path': str(web_caches_path),
+        'web_caches_mtime': web_caches_mtime,
+        'cache_path': str(path)
+    })
+    return path
+
+def copy_cache_file(path):
     # create a copy of the file so we can also access it while genshin is running.
     # python cannot do this without raising an error, and neither can the default
     # windows copy command, so we instead delegate this task to powershell's Copy-Item
     try:
-        path = Path(game_path) / 'GenshinImpact_Data/webCaches/2.13.0.1/Cache/Cache_Data/data_2'
-        logging.debug('cache path is: ' + str(path))
-        if not path.exists():
-            logging.debug('cache file does not exist')
-            return None
-
         copy_path = get_data_path() / 'data_2'
         if sys.platform == 'win32':
             subprocess.check_output(f'powershell.exe -Command "Copy-Item \'{path}\' \'{copy_path}\'"', shell=True)
@@ -93,7 +199,7 @@ def get_cache_path():
     return copy_path
 
 def set_up_logging():
-    log_level = logging.DEBUG if len(sys.argv) > 1 and sys.argv[1] == '--debug' else logging.INFO
+    log_level = logging.DEBUG if '--debug' in sys.argv[1:] else logging.INFO
     log_format = '%(asctime)s %(levelname)s: %(message)s'
     logging.basicConfig(filename=(get_data_path() / 'wishing-well.log'), format=log_format, level=log_level)
 
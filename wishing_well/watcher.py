@@ -0,0 +1,190 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import sys
+from threading import Event, Thread
+
+from .client import Client
+from .exceptions import AuthTokenExtractionError
+from .util import find_cache_file, get_game_path
+
+
+# inotify through ctypes, watching a single directory. None if it's not available
+class _Inotify:
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, libc, fd, watch_descriptor):
+        self._libc = libc
+        self._fd = fd
+        self._watch_descriptor = watch_descriptor
+
+    @classmethod
+    def watch(cls, path):
+        if sys.platform != 'linux':
+            return None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(cls.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            logging.warning('Could not set up inotify: %s', os.strerror(ctypes.get_errno()))
+            return None
+
+        mask = cls.IN_MODIFY | cls.IN_CLOSE_WRITE | cls.IN_MOVED_TO | cls.IN_CREATE
+        watch_descriptor = libc.inotify_add_watch(fd, os.fsencode(path), mask)
+        if watch_descriptor < 0:
+            logging.warning('Could not watch %s: %s', path, os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return None
+
+        return cls(libc, fd, watch_descriptor)
+
+    # wait until something in the directory changed, or the timeout passed.
+    # we don't care about the events themselves, so they are simply drained
+    def wait(self, timeout):
+        readable, _, _ = select.select([ self._fd ], [], [], timeout)
+        if len(readable) == 0:
+            return False
+
+        os.read(self._fd, 64 * 1024)
+        return True
+
+    def close(self):
+        self._libc.inotify_rm_watch(self._fd, self._watch_descriptor)
+        os.close(self._fd)
+
+
+# watches the web cache file of the game for new wish history urls, and calls
+# callback(region, auth_token) whenever one with a new auth token shows up.
+# the cache file is read in place, which windows doesn't allow while the game
+# is running, so there the watcher doesn't do anything. changes are noticed
+# through inotify on linux, and by checking the file every now and then
+# elsewhere. only bytes appended since the last check are searched
+class CacheWatcher:
+    POLL_INTERVAL = 2  # seconds
+    RESOLVE_INTERVAL = 60  # seconds to look for a different cache file, e.g. after a game update
+    OVERLAP = 4096  # bytes searched again, in case a url was only partially written
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._stop = Event()
+        self._thread = None
+        self._path = None
+        self._offset = 0
+        self._tail = b''
+        self._auth_token = None
+
+    def start(self):
+        if not Client.READ_CACHE_FILE_IN_PLACE:
+            logging.warning('Watching the cache file is not supported on this platform')
+            return
+
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _resolve_path(self):
+        game_path = get_game_path()
+        return find_cache_file(game_path) if game_path is not None else None
+
+    def _run(self):
+        while not self._stop.is_set():
+            path = self._resolve_path()
+            if path is None:
+                logging.debug('No cache file to watch yet')
+                self._stop.wait(self.RESOLVE_INTERVAL)
+                continue
+
+            if path != self._path:
+                logging.info('Watching cache file %s', path)
+                self._path = path
+                self._auth_token = None
+                # the url that is already there is not new, so only remember its auth token
+                self._rescan(notify=False)
+
+            self._watch(path)
+
+    # wait for changes to the cache file until it's time to resolve its path again
+    def _watch(self, path):
+        inotify = _Inotify.watch(path.parent)
+        waited = 0
+        try:
+            while not self._stop.is_set() and waited < self.RESOLVE_INTERVAL:
+                if inotify is not None:
+                    changed = inotify.wait(self.POLL_INTERVAL)
+                else:
+                    changed = not self._stop.wait(self.POLL_INTERVAL)
+                waited += self.POLL_INTERVAL
+
+                if changed:
+                    self._scan()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    # search the whole file, memory-mapped and from the end
+    def _rescan(self, notify):
+        try:
+            with self._path.open('rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                fp.seek(max(0, size - self.OVERLAP))
+                self._tail = fp.read(self.OVERLAP)
+            url = Client._find_last_auth_token_url(self._path)
+        except OSError as err:
+            logging.debug('Could not read cache file: %s', err)
+            size = 0
+            self._tail = b''
+            url = None
+
+        self._offset = size
+        self._handle_url(url, notify)
+
+    # search only what was appended since the last scan
+    def _scan(self):
+        try:
+            with self._path.open('rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                if size == self._offset:
+                    return
+                if size < self._offset:
+                    # the file was truncated or replaced, start over
+                    self._rescan(notify=True)
+                    return
+
+                fp.seek(self._offset)
+                data = self._tail + fp.read(size - self._offset)
+        except OSError as err:
+            logging.debug('Could not read cache file: %s', err)
+            return
+
+        self._offset = size
+        self._tail = data[-self.OVERLAP:]
+        self._handle_url(Client._search_last_auth_token_url(data), notify=True)
+
+    def _handle_url(self, url, notify):
+        if url is None:
+            return
+
+        try:
+            region, auth_token = Client.extract_region_and_auth_token(url)
+        except AuthTokenExtractionError:
+            return
+        if auth_token == self._auth_token:
+            return
+
+        self._auth_token = auth_token
+        if notify:
+            logging.info('Found a new auth token in the cache file')
+            self._callback(region, auth_token)